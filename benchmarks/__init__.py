@@ -0,0 +1,4 @@
+"""
+Benchmarks for the default model steps, run against a synthetic region -
+see synthetic.py for the region and run.py to run them.
+"""
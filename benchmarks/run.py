@@ -0,0 +1,175 @@
+"""
+Run the default model steps against a synthetic region and record how long
+each step takes and how much memory it uses, e.g.
+
+    python -m benchmarks.run --agents 100000 --years 2 --out base.json
+    python -m benchmarks.run --agents 100000 --years 2 --compare base.json
+
+The region is written once for each size and seed and reused after that.
+The developer steps aren't run because they need callbacks (prices, zoning
+and building types) which are defined by each region.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+
+from benchmarks import synthetic
+
+DEFAULT_STEPS = [
+    "neighborhood_vars",
+    "price_vars",
+    "rsh_simulate",
+    "nrh_simulate",
+    "households_relocation",
+    "jobs_relocation",
+    "households_transition",
+    "jobs_transition",
+    "hlcm_simulate",
+    "elcm_simulate",
+    "diagnostic_output"
+]
+
+
+def run_benchmark(data_home, agents=10000, years=1, steps=None, seed=0,
+                  start_year=2010, memory=False):
+    """
+    Generate (if needed) and run a synthetic region with profiling enabled.
+
+    Parameters
+    ----------
+    data_home : str
+        Where the regions are kept - each size and seed is in its own
+        directory
+    agents : int, optional
+        The number of households in the region
+    years : int, optional
+        The number of years to simulate
+    steps : list of str, optional
+        The steps to run, DEFAULT_STEPS if not given
+    seed : int, optional
+        The seed of the synthetic region
+    start_year : int, optional
+        The first simulated year
+    memory : boolean, optional
+        Also record the peak memory allocated by each step, which slows the
+        run down
+
+    Returns
+    -------
+    The run report (see urbansim_defaults.utils.run_report) with the table
+    sizes of the region under "sizes"
+    """
+    data_home = os.path.abspath(
+        os.path.join(data_home, "region_%d_%d" % (agents, seed)))
+    if not os.path.exists(os.path.join(data_home, "configs")):
+        print("Generating a region with %d households in %s" %
+              (agents, data_home))
+        synthetic.generate_region(data_home, agents, start_year,
+                                  max(years, 30), seed)
+    sizes = synthetic.region_sizes(agents)
+
+    # urbansim finds the data and configs through DATA_HOME, so it has to be
+    # set before the steps are run
+    os.environ["DATA_HOME"] = data_home
+    import orca
+    from urbansim_defaults import models  # noqa: registers the steps
+    from urbansim_defaults import utils
+
+    utils.enable_profiling(memory=memory)
+    orca.run(steps or DEFAULT_STEPS,
+             iter_vars=range(start_year, start_year + years))
+
+    report = utils.run_report()
+    report["sizes"] = sizes
+    return report
+
+
+def print_report(report):
+    for year, steps in sorted(report["years"].items()):
+        print("Year %s" % year)
+        for name, t in steps.items():
+            line = "    {:<28}{:>10.2f}s wall{:>10.2f}s cpu{:>10.1f}MB rss".\
+                format(name, t["wall_time"], t["cpu_time"],
+                       t["rss_delta"] / 1e6)
+            if "peak_memory" in t:
+                line += "{:>10.1f}MB peak".format(t["peak_memory"] / 1e6)
+            print(line)
+
+
+def compare_reports(report, baseline, threshold=.2):
+    """
+    Find the steps which got slower than in a baseline report.
+
+    Parameters
+    ----------
+    report : dict
+        The run report to check
+    baseline : dict
+        The run report to compare to
+    threshold : float, optional
+        How much slower (as a share of the baseline wall time) a step has to
+        be to count as a regression
+
+    Returns
+    -------
+    A list of (year, step, baseline seconds, seconds)
+    """
+    regressions = []
+    for year, steps in sorted(report["years"].items()):
+        for name, t in steps.items():
+            base = baseline["years"].get(year, {}).get(name)
+            if base is None:
+                continue
+            if t["wall_time"] > base["wall_time"] * (1 + threshold):
+                regressions.append(
+                    (year, name, base["wall_time"], t["wall_time"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--agents", type=int, default=10000,
+                        help="number of households in the region")
+    parser.add_argument("--years", type=int, default=1,
+                        help="number of years to simulate")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for the synthetic region")
+    parser.add_argument("--steps", nargs="+", default=None,
+                        help="steps to run (defaults to the standard ones)")
+    parser.add_argument("--data-home", default="benchmark_regions",
+                        help="where to keep the synthetic regions")
+    parser.add_argument("--memory", action="store_true",
+                        help="record the peak memory of each step (slower)")
+    parser.add_argument("--out", default=None,
+                        help="write the run report as json to this file")
+    parser.add_argument("--compare", default=None,
+                        help="a run report to check for regressions against")
+    parser.add_argument("--threshold", type=float, default=.2,
+                        help="slow down (as a share) counted as a regression")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.data_home, args.agents, args.years,
+                           args.steps, args.seed, memory=args.memory)
+    print_report(report)
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(report, f, default=str)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_reports(report, baseline, args.threshold)
+        for year, name, before, after in regressions:
+            print("REGRESSION: %s in %s took %.2fs (was %.2fs)" %
+                  (name, year, after, before))
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
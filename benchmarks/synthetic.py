@@ -0,0 +1,396 @@
+"""
+Generate a synthetic region with everything the default model steps need -
+parcels, buildings, households, jobs, zones, a network, control totals,
+model configurations and settings - at any scale.  The values are random
+but plausible, so the region is good for measuring how long the steps take
+and not for anything else.
+"""
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import pandas as pd
+import yaml
+
+BUILDING_TYPE_MAP = {
+    1: "Residential",
+    2: "Residential",
+    3: "Office",
+    4: "Retail",
+    5: "Industrial"
+}
+
+BUILDING_SQFT_PER_JOB = {-1: 400, 1: 400, 2: 400, 3: 355, 4: 445, 5: 661}
+
+# the network is a grid of nodes this far apart, with edges between
+# neighbors
+NODE_SPACING = 200.0
+
+MAX_DISTANCE = 1500
+
+
+def region_sizes(agents):
+    """
+    Get the number of rows in each table for a region with the given number
+    of households (there are half as many jobs).
+
+    Parameters
+    ----------
+    agents : int
+        The number of households
+
+    Returns
+    -------
+    A dict of table name to number of rows
+    """
+    return {
+        "households": agents,
+        "jobs": agents // 2,
+        "buildings": max(agents // 8, 100),
+        "parcels": max(agents // 10, 100),
+        "nodes": max(agents // 100, 100),
+        "zones": max(agents // 2000, 10)
+    }
+
+
+def _network(n, rng):
+    side = int(np.ceil(np.sqrt(n)))
+    ids = np.arange(side * side)
+    nodes = pd.DataFrame({
+        "x": (ids % side) * NODE_SPACING,
+        "y": (ids // side) * NODE_SPACING
+    }, index=pd.Index(ids, name="node_id"))
+
+    right = ids[ids % side < side - 1]
+    down = ids[ids < side * (side - 1)]
+    edge_from = np.concatenate([right, down])
+    edges = pd.DataFrame({
+        "from": edge_from,
+        "to": np.concatenate([right + 1, down + side]),
+        "weight": NODE_SPACING * rng.uniform(1, 1.5, len(edge_from))
+    })
+    return nodes, edges, side
+
+
+def _parcels(n, side, zone_side, rng):
+    extent = (side - 1) * NODE_SPACING
+    x = rng.uniform(0, extent, n)
+    y = rng.uniform(0, extent, n)
+    node_x = np.round(x / NODE_SPACING).astype('int')
+    node_y = np.round(y / NODE_SPACING).astype('int')
+    zone_x = np.minimum((x / extent * zone_side).astype('int'), zone_side - 1)
+    zone_y = np.minimum((y / extent * zone_side).astype('int'), zone_side - 1)
+    return pd.DataFrame({
+        "x": x,
+        "y": y,
+        "node_id": node_y * side + node_x,
+        "zone_id": zone_y * zone_side + zone_x + 1,
+        "shape_area": rng.lognormal(9, 1, n),
+        "max_dua": rng.uniform(0, 50, n).round(),
+        "max_far": rng.uniform(0, 4, n).round(1)
+    }, index=pd.Index(np.arange(1, n + 1), name="parcel_id"))
+
+
+def _spread(total, n, rng):
+    # split total into n parts of at least one
+    return rng.multinomial(max(total - n, 0), np.ones(n) / n) + 1
+
+
+def _buildings(n, parcel_ids, households, jobs, rng):
+    df = pd.DataFrame({
+        "parcel_id": rng.choice(parcel_ids, n),
+        "building_type_id": rng.choice([1, 2, 3, 4, 5], n,
+                                       p=[.5, .2, .1, .1, .1]),
+        "year_built": rng.randint(1900, 2010, n),
+        "stories": rng.randint(1, 10, n),
+        "residential_units": 0,
+        "non_residential_sqft": 0
+    }, index=pd.Index(np.arange(1, n + 1), name="building_id"))
+
+    # leave about 10% of the units and job spaces vacant
+    residential = df.building_type_id.isin([1, 2]).values
+    df.loc[residential, "residential_units"] = _spread(
+        int(households * 1.1), residential.sum(), rng)
+    sqft_per_job = df.building_type_id.map(BUILDING_SQFT_PER_JOB).values
+    df.loc[~residential, "non_residential_sqft"] = _spread(
+        int(jobs * 1.1), (~residential).sum(), rng) * sqft_per_job[~residential]
+
+    df["building_sqft"] = df.residential_units * 1200 + \
+        df.non_residential_sqft
+    df["residential_price"] = np.where(
+        residential, rng.lognormal(6, .4, n), 0)
+    df["non_residential_price"] = np.where(
+        residential, 0, rng.lognormal(3.4, .4, n))
+    return df
+
+
+def _place(capacity, n, rng, share=.95):
+    # put share of the agents in random free spaces and leave the rest
+    # unplaced
+    spaces = np.repeat(capacity.index.values, capacity.values.astype('int'))
+    placed = min(int(n * share), len(spaces))
+    building_id = np.full(n, -1, dtype='int')
+    building_id[:placed] = rng.permutation(spaces)[:placed]
+    return rng.permutation(building_id)
+
+
+def _households(n, buildings, start_year, rng):
+    return pd.DataFrame({
+        "building_id": _place(buildings.residential_units, n, rng),
+        "income": rng.lognormal(11, .7, n).round(),
+        "persons": rng.randint(1, 7, n),
+        "tenure": rng.randint(1, 3, n),
+        "move_in_year": rng.randint(start_year - 30, start_year, n)
+    }, index=pd.Index(np.arange(1, n + 1), name="household_id"))
+
+
+def _jobs(n, buildings, start_year, rng):
+    job_spaces = (buildings.non_residential_sqft /
+                  buildings.building_type_id.map(BUILDING_SQFT_PER_JOB)).\
+        fillna(0)
+    return pd.DataFrame({
+        "building_id": _place(job_spaces, n, rng),
+        "sector_id": rng.randint(1, 21, n),
+        "move_in_year": rng.randint(start_year - 30, start_year, n)
+    }, index=pd.Index(np.arange(1, n + 1), name="job_id"))
+
+
+def _controls(start_year, years, total, column, growth=.01):
+    index = pd.Index(np.arange(start_year, start_year + years + 1),
+                     name="year")
+    return pd.DataFrame({
+        column: (total * (1 + growth) ** np.arange(len(index))).astype('int')
+    }, index=index)
+
+
+def _regression(name, expression, coefficients, filters):
+    return {
+        "name": name,
+        "model_type": "regression",
+        "fit_filters": filters,
+        "predict_filters": filters,
+        "model_expression": expression,
+        "ytransform": "np.exp",
+        "fitted": True,
+        "fit_parameters": {
+            "Coefficient": coefficients,
+            "Std. Error": {k: .01 for k in coefficients},
+            "T-Score": {k: v / .01 for k, v in coefficients.items()}
+        },
+        "fit_rsquared": .5,
+        "fit_rsquared_adj": .5
+    }
+
+
+def _location_choice(name, coefficients, alts_filters):
+    return {
+        "name": name,
+        "model_type": "discretechoice",
+        "model_expression": " + ".join(coefficients) + " - 1",
+        "sample_size": 50,
+        "probability_mode": "single_chooser",
+        "choice_mode": "aggregate",
+        "choosers_fit_filters": None,
+        "choosers_predict_filters": None,
+        "alts_fit_filters": alts_filters,
+        "alts_predict_filters": alts_filters,
+        "interaction_predict_filters": None,
+        "estimation_sample_size": None,
+        "prediction_sample_size": None,
+        "choice_column": None,
+        "fitted": True,
+        "log_likelihoods": {
+            "null": -1000.0, "convergence": -900.0, "ratio": .1},
+        "fit_parameters": {
+            "Coefficient": coefficients,
+            "Std. Error": {k: .01 for k in coefficients},
+            "T-Score": {k: v / .01 for k, v in coefficients.items()}
+        }
+    }
+
+
+def _variable(name, dataframe, radius, aggregation="sum", decay="linear",
+              varname=None, filters=None):
+    v = {
+        "name": name,
+        "dataframe": dataframe,
+        "radius": radius,
+        "aggregation": aggregation,
+        "decay": decay
+    }
+    if varname is not None:
+        v["varname"] = varname
+    if filters is not None:
+        v["filters"] = filters
+    return v
+
+
+def _configs():
+    residential = ["residential_units > 0"]
+    non_residential = ["non_residential_sqft > 0"]
+    return {
+        "settings.yaml": {
+            "store": "synthetic.h5",
+            "build_networks": {
+                "name": "synthetic_network.h5",
+                "max_distance": MAX_DISTANCE
+            },
+            "building_type_map": BUILDING_TYPE_MAP,
+            "building_sqft_per_job": BUILDING_SQFT_PER_JOB,
+            "aggregation_tables": ["nodes"],
+            "scenario": "baseline",
+            "scenario_inputs": {},
+            "rates": {
+                "households_relocation": .05,
+                "jobs_relocation": .05,
+                "simple_households_transition": .01,
+                "simple_jobs_transition": .01
+            },
+            "households_transition": {
+                "total_column": "total_number_of_households"
+            },
+            "jobs_transition": {
+                "total_column": "total_number_of_jobs"
+            }
+        },
+        "neighborhood_vars.yaml": {
+            "name": "neighborhood_vars",
+            "model_type": "networkaggregation",
+            "node_col": "node_id",
+            "variable_definitions": [
+                _variable("sum_residential_units", "buildings", 1000,
+                          varname="residential_units"),
+                _variable("sum_job_spaces", "buildings", 1000,
+                          varname="job_spaces"),
+                _variable("population", "households", 1000),
+                _variable("jobs", "jobs", 1000),
+                _variable("ave_income", "households", 1000,
+                          aggregation="ave", decay="flat", varname="income"),
+                _variable("ave_sqft_per_unit", "buildings", 1000,
+                          aggregation="ave", decay="flat",
+                          varname="sqft_per_unit", filters=residential)
+            ]
+        },
+        "price_vars.yaml": {
+            "name": "price_vars",
+            "model_type": "networkaggregation",
+            "node_col": "node_id",
+            "variable_definitions": [
+                _variable("residential", "buildings", 1500,
+                          aggregation="ave", decay="flat",
+                          varname="residential_price", filters=residential),
+                _variable("non_residential", "buildings", 1500,
+                          aggregation="ave", decay="flat",
+                          varname="non_residential_price",
+                          filters=non_residential)
+            ]
+        },
+        "rsh.yaml": _regression(
+            "rsh",
+            "np.log1p(residential_price) ~ np.log1p(sqft_per_unit) + "
+            "np.log1p(sum_residential_units) + np.log1p(ave_income)",
+            {"Intercept": 4.0,
+             "np.log1p(sqft_per_unit)": .1,
+             "np.log1p(sum_residential_units)": .05,
+             "np.log1p(ave_income)": .1},
+            residential),
+        "nrh.yaml": _regression(
+            "nrh",
+            "np.log1p(non_residential_price) ~ np.log1p(sum_job_spaces) + "
+            "np.log1p(population)",
+            {"Intercept": 3.0,
+             "np.log1p(sum_job_spaces)": .02,
+             "np.log1p(population)": .02},
+            non_residential),
+        "hlcm.yaml": _location_choice(
+            "hlcm",
+            {"np.log1p(residential_price)": -.5,
+             "np.log1p(sum_residential_units)": .2,
+             "np.log1p(ave_income)": .3},
+            residential),
+        "elcm.yaml": _location_choice(
+            "elcm",
+            {"np.log1p(non_residential_price)": -.3,
+             "np.log1p(sum_job_spaces)": .2,
+             "np.log1p(population)": .1},
+            non_residential)
+    }
+
+
+def generate_region(data_home, agents=10000, start_year=2010, years=30,
+                    seed=0):
+    """
+    Write a synthetic region to data_home, laid out the way urbansim
+    expects (data/ and configs/, see urbansim.utils.misc), so that the
+    default steps can be run against it with DATA_HOME set to data_home.
+
+    Parameters
+    ----------
+    data_home : str
+        The directory to write the region to
+    agents : int, optional
+        The number of households - the other tables are scaled to match,
+        see region_sizes
+    start_year : int, optional
+        The base year
+    years : int, optional
+        The number of years of control totals to write
+    seed : int, optional
+        The seed for the random values, so a region can be regenerated
+        exactly
+
+    Returns
+    -------
+    A dict of table name to number of rows
+    """
+    rng = np.random.RandomState(seed)
+    sizes = region_sizes(agents)
+    data_dir = os.path.join(data_home, "data")
+    configs_dir = os.path.join(data_home, "configs")
+    for d in [data_dir, configs_dir, os.path.join(data_home, "runs")]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    nodes, edges, side = _network(sizes["nodes"], rng)
+    zone_side = int(np.ceil(np.sqrt(sizes["zones"])))
+    zone_ids = np.arange(1, zone_side * zone_side + 1)
+    zones = pd.DataFrame({
+        "x": ((zone_ids - 1) % zone_side + .5) / zone_side * side *
+        NODE_SPACING,
+        "y": ((zone_ids - 1) // zone_side + .5) / zone_side * side *
+        NODE_SPACING
+    }, index=pd.Index(zone_ids, name="zone_id"))
+    parcels = _parcels(sizes["parcels"], side, zone_side, rng)
+    buildings = _buildings(sizes["buildings"], parcels.index.values,
+                           sizes["households"], sizes["jobs"], rng)
+    households = _households(sizes["households"], buildings, start_year, rng)
+    jobs = _jobs(sizes["jobs"], buildings, start_year, rng)
+
+    with pd.HDFStore(os.path.join(data_dir, "synthetic.h5"), "w") as store:
+        store["parcels"] = parcels
+        store["buildings"] = buildings
+        store["households"] = households
+        store["jobs"] = jobs
+        store["zones"] = zones
+    with pd.HDFStore(os.path.join(data_dir, "synthetic_network.h5"),
+                     "w") as store:
+        store["nodes"] = nodes
+        store["edges"] = edges
+
+    _controls(start_year, years, len(households),
+              "total_number_of_households").\
+        to_csv(os.path.join(data_dir, "household_controls.csv"))
+    _controls(start_year, years, len(jobs), "total_number_of_jobs").\
+        to_csv(os.path.join(data_dir, "employment_controls.csv"))
+    pd.DataFrame({"logsum": rng.normal(0, 1, len(zones))},
+                 index=pd.Index(zones.index, name="taz")).\
+        to_csv(os.path.join(data_dir, "logsums.csv"))
+
+    for name, cfg in _configs().items():
+        with open(os.path.join(configs_dir, name), "w") as f:
+            yaml.safe_dump(cfg, f, default_flow_style=False)
+
+    sizes.update({"nodes": len(nodes), "edges": len(edges),
+                  "zones": len(zones)})
+    return sizes
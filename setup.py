@@ -15,7 +15,7 @@ setup(
         'Programming Language :: Python :: 3.7',
         'License :: OSI Approved :: BSD License'
     ],
-    packages=find_packages(exclude=['*.tests']),
+    packages=find_packages(exclude=['*.tests', 'benchmarks']),
     install_requires=[
         'numpy',
         'orca',
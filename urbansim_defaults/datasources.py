@@ -41,9 +41,18 @@ def uuid_hex():
 
 @orca.injectable('store', cache=True)
 def hdfstore(settings):
-    return pd.HDFStore(
-        os.path.join(misc.data_dir(), settings["store"]),
-        mode='r')
+    hdf_path = os.path.join(misc.data_dir(), settings["store"])
+
+    if settings.get("columnar_store", None) is not None:
+        # read the tables from a memory mapped columnar snapshot of the
+        # store, which is (re)written whenever the store has changed
+        path = os.path.join(misc.data_dir(), settings["columnar_store"])
+        if not utils.columnar_store_is_current(hdf_path, path):
+            utils.write_columnar_store(hdf_path, path)
+        return utils.ColumnarStore(
+            path, columns=settings.get("store_columns", None))
+
+    return pd.HDFStore(hdf_path, mode='r')
 
 
 @orca.injectable("summary", cache=True)
@@ -108,6 +117,10 @@ def buildings(store, households, jobs, building_sqft_per_job, settings):
     if fill_nas_cfg is not None:
         df = utils.table_reprocess(fill_nas_cfg, df)
 
+    compact_cfg = settings.get("compact_dtypes", {}).get("buildings", None)
+    if compact_cfg is not None:
+        df = utils.compact_dtypes(compact_cfg, df, "buildings")
+
     return df
 
 
@@ -123,28 +136,43 @@ def employment_controls():
     return df.set_index('year')
 
 
+# the sorted ids of the buildings in the store, read without the buildings
+# columns and shared by the agent tables to check their building ids
+@orca.injectable('store_building_ids', cache=True)
+def store_building_ids(store):
+    return np.unique(utils.read_index(store, 'buildings'))
+
+
 @orca.table('jobs', cache=True)
-def jobs(store, settings):
+def jobs(store, settings, store_building_ids):
     df = store['jobs']
 
     if settings.get("remove_invalid_building_ids", True):
         # have to do it this way to prevent circular reference
-        df.building_id.loc[~df.building_id.isin(store['buildings'].index)] = -1
+        valid = utils.sorted_isin(df.building_id.values,
+                                  store_building_ids)
+        df.loc[~valid, "building_id"] = -1
 
     fill_nas_cfg = settings.get("table_reprocess", {}).get("jobs", None)
     if fill_nas_cfg is not None:
         df = utils.table_reprocess(fill_nas_cfg, df)
 
+    compact_cfg = settings.get("compact_dtypes", {}).get("jobs", None)
+    if compact_cfg is not None:
+        df = utils.compact_dtypes(compact_cfg, df, "jobs")
+
     return df
 
 
 @orca.table('households', cache=True)
-def households(store, settings):
+def households(store, settings, store_building_ids):
     df = store['households']
 
     if settings.get("remove_invalid_building_ids", True):
         # have to do it this way to prevent circular reference
-        df.building_id.loc[~df.building_id.isin(store['buildings'].index)] = -1
+        valid = utils.sorted_isin(df.building_id.values,
+                                  store_building_ids)
+        df.loc[~valid, "building_id"] = -1
 
     fill_nas_cfg = settings.get("table_reprocess", None)
     if fill_nas_cfg is not None:
@@ -152,6 +180,10 @@ def households(store, settings):
     if fill_nas_cfg is not None:
         df = utils.table_reprocess(fill_nas_cfg, df)
 
+    compact_cfg = settings.get("compact_dtypes", {}).get("households", None)
+    if compact_cfg is not None:
+        df = utils.compact_dtypes(compact_cfg, df, "households")
+
     return df
 
 
@@ -1,5 +1,6 @@
 from __future__ import print_function
 
+import collections
 import os
 import time
 
@@ -8,22 +9,35 @@ import orca
 import pandana as pdna
 import pandas as pd
 from urbansim.utils import misc
-from urbansim.utils import networks
 from urbansim_defaults import utils
 
 from urbansim_defaults import datasources
 from urbansim_defaults import variables
 
 
+@orca.step('preload_tables')
+def preload_tables(settings):
+    # the tables are all cached, so only the first call does any work
+    kwargs = dict(settings.get('preload_tables', {}))
+    table_names = kwargs.pop('tables', [
+        'parcels', 'zones', 'households', 'jobs', 'logsums',
+        'household_controls', 'employment_controls', 'buildings'])
+    return utils.preload_tables(table_names, **kwargs)
+
+
 @orca.step('rsh_estimate')
 def rsh_estimate(homesales, aggregations):
     return utils.hedonic_estimate("rsh.yaml", homesales, aggregations)
 
 
 @orca.step('rsh_simulate')
-def rsh_simulate(buildings, aggregations):
+def rsh_simulate(buildings, aggregations, settings):
     return utils.hedonic_simulate("rsh.yaml", buildings, aggregations,
-                                  "residential_price")
+                                  "residential_price",
+                                  workers=settings.get("segment_workers"),
+                                  chunksize=settings.get("hedonic_chunksize"),
+                                  incremental=settings.get(
+                                      "incremental_hedonic", False))
 
 
 @orca.step('nrh_estimate')
@@ -32,9 +46,13 @@ def nrh_estimate(costar, aggregations):
 
 
 @orca.step('nrh_simulate')
-def nrh_simulate(buildings, aggregations):
+def nrh_simulate(buildings, aggregations, settings):
     return utils.hedonic_simulate("nrh.yaml", buildings, aggregations,
-                                  "non_residential_price")
+                                  "non_residential_price",
+                                  workers=settings.get("segment_workers"),
+                                  chunksize=settings.get("hedonic_chunksize"),
+                                  incremental=settings.get(
+                                      "incremental_hedonic", False))
 
 
 @orca.step('hlcm_estimate')
@@ -49,7 +67,10 @@ def hlcm_simulate(households, buildings, aggregations, settings):
                               aggregations,
                               "building_id", "residential_units",
                               "vacant_residential_units",
-                              settings.get("enable_supply_correction", None))
+                              settings.get("enable_supply_correction", None),
+                              capacity_weighted=settings.get(
+                                  "capacity_weighted_lcm", False),
+                              workers=settings.get("segment_workers"))
 
 
 @orca.step('elcm_estimate')
@@ -59,10 +80,13 @@ def elcm_estimate(jobs, buildings, aggregations):
 
 
 @orca.step('elcm_simulate')
-def elcm_simulate(jobs, buildings, aggregations):
+def elcm_simulate(jobs, buildings, aggregations, settings):
     return utils.lcm_simulate("elcm.yaml", jobs, buildings, aggregations,
                               "building_id", "job_spaces",
-                              "vacant_job_spaces")
+                              "vacant_job_spaces",
+                              capacity_weighted=settings.get(
+                                  "capacity_weighted_lcm", False),
+                              workers=settings.get("segment_workers"))
 
 
 @orca.step('households_relocation')
@@ -107,33 +131,74 @@ def simple_jobs_transition(jobs, settings):
     return utils.simple_transition(jobs, rate, "building_id")
 
 
+# built and precomputed networks, keyed by the network file (its path, size
+# and modification time) and the precompute distance, so runs which clear
+# the orca caches while running several scenarios in one process don't build
+# the same network again - only the build_networks "cache_size" most
+# recently used networks are kept (one by default).  This doesn't make a new
+# process any faster: pandana can't save the contraction hierarchy or the
+# precomputed ranges, and those are most of the cost of building a network
+_NETWORKS = collections.OrderedDict()
+
+
 @orca.injectable('net', cache=True)
 def build_networks(settings):
     name = settings['build_networks']['name']
-    st = pd.HDFStore(os.path.join(misc.data_dir(), name), "r")
-    nodes, edges = st.nodes, st.edges
-    net = pdna.Network(nodes["x"], nodes["y"], edges["from"], edges["to"],
-                       edges[["weight"]])
-    net.precompute(settings['build_networks']['max_distance'])
+    max_distance = settings['build_networks']['max_distance']
+    cache_size = settings['build_networks'].get('cache_size', 1)
+    path = os.path.join(misc.data_dir(), name)
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime,
+           float(max_distance))
+
+    net = _NETWORKS.pop(key, None)
+    if net is None:
+        st = pd.HDFStore(path, "r")
+        nodes, edges = st.nodes, st.edges
+        st.close()
+        net = pdna.Network(nodes["x"], nodes["y"], edges["from"], edges["to"],
+                           edges[["weight"]])
+        net.precompute(max_distance)
+    _NETWORKS[key] = net
+    while len(_NETWORKS) > cache_size:
+        _NETWORKS.popitem(last=False)
     return net
 
 
 @orca.step('neighborhood_vars')
-def neighborhood_vars(net):
-    nodes = networks.from_yaml(net, "neighborhood_vars.yaml")
+def neighborhood_vars(net, settings):
+    nodes = utils.accessibility_variables(
+        net, ["neighborhood_vars.yaml"],
+        incremental=settings.get("incremental_accessibility", False))
     nodes = nodes.fillna(0)
     print(nodes.describe())
-    orca.add_table("nodes", nodes)
+    utils.add_table("nodes", nodes)
 
 
 @orca.step('price_vars')
 def price_vars(net):
-    nodes2 = networks.from_yaml(net, "price_vars.yaml")
+    nodes2 = utils.accessibility_variables(net, ["price_vars.yaml"])
     nodes2 = nodes2.fillna(0)
     print(nodes2.describe())
     nodes = orca.get_table('nodes')
     nodes = nodes.to_frame().join(nodes2)
-    orca.add_table("nodes", nodes)
+    utils.add_table("nodes", nodes)
+
+
+# this does the work of neighborhood_vars and price_vars in one pass, and
+# writes the nodes table once - the tables are read before any variable is
+# computed, so price_vars.yaml can't aggregate columns which are computed
+# from the neighborhood variables
+@orca.step('accessibility_vars')
+def accessibility_vars(net, settings):
+    cfgnames = settings.get("accessibility_configs",
+                            ["neighborhood_vars.yaml", "price_vars.yaml"])
+    nodes = utils.accessibility_variables(
+        net, cfgnames,
+        incremental=settings.get("incremental_accessibility", False))
+    nodes = nodes.fillna(0)
+    print(nodes.describe())
+    utils.add_table("nodes", nodes)
 
 
 @orca.step('feasibility')
@@ -215,44 +280,66 @@ def scheduled_development_events(buildings, development_projects, summary, year)
 
 
 @orca.step("diagnostic_output")
-def diagnostic_output(households, buildings, parcels, zones, year, summary):
-    households = households.to_frame()
-    buildings = buildings.to_frame()
-    parcels = parcels.to_frame()
+def diagnostic_output(households, buildings, parcels, zones, year, summary,
+                      settings):
+    # only the columns used below are loaded, the zone of each row is looked
+    # up once, and each indicator is a single grouped reduction
+    approximate = settings.get("diagnostic_quantiles", "exact") == "approx"
+    households = households.to_frame(['zone_id', 'income', 'persons'])
+    buildings = buildings.to_frame(
+        ['zone_id', 'general_type', 'residential_units',
+         'non_residential_sqft', 'residential_price',
+         'non_residential_price'])
+    parcels = parcels.to_frame(['zone_id', 'zoned_du', 'zoned_du_underbuild'])
     zones = zones.to_frame()
+    n = len(zones)
 
-    zones['zoned_du'] = parcels.groupby('zone_id').zoned_du.sum()
-    zones['zoned_du_underbuild'] = parcels.groupby('zone_id').\
-        zoned_du_underbuild.sum()
+    codes = utils.group_codes(zones.index, parcels.zone_id)
+    zones['zoned_du'] = utils.grouped_sums(codes, n, parcels.zoned_du)
+    zones['zoned_du_underbuild'] = utils.grouped_sums(
+        codes, n, parcels.zoned_du_underbuild)
     zones['zoned_du_underbuild_ratio'] = zones.zoned_du_underbuild /\
         zones.zoned_du
 
-    zones['residential_units'] = buildings.groupby('zone_id').\
-        residential_units.sum()
-    zones['non_residential_sqft'] = buildings.groupby('zone_id').\
-        non_residential_sqft.sum()
-
-    zones['retail_sqft'] = buildings.query('general_type == "Retail"').\
-        groupby('zone_id').non_residential_sqft.sum()
-    zones['office_sqft'] = buildings.query('general_type == "Office"').\
-        groupby('zone_id').non_residential_sqft.sum()
-    zones['industrial_sqft'] = buildings.query('general_type == "Industrial"').\
-        groupby('zone_id').non_residential_sqft.sum()
-
-    zones['average_income'] = households.groupby('zone_id').income.quantile()
-    zones['household_size'] = households.groupby('zone_id').persons.quantile()
-
-    zones['building_count'] = buildings.\
-        query('general_type == "Residential"').groupby('zone_id').size()
-    zones['residential_price'] = buildings.\
-        query('general_type == "Residential"').groupby('zone_id').\
-        residential_price.quantile()
-    zones['retail_rent'] = buildings[buildings.general_type == "Retail"].\
-        groupby('zone_id').non_residential_price.quantile()
-    zones['office_rent'] = buildings[buildings.general_type == "Office"].\
-        groupby('zone_id').non_residential_price.quantile()
-    zones['industrial_rent'] = \
-        buildings[buildings.general_type == "Industrial"].\
-        groupby('zone_id').non_residential_price.quantile()
+    codes = utils.group_codes(zones.index, buildings.zone_id)
+    zones['residential_units'] = utils.grouped_sums(
+        codes, n, buildings.residential_units)
+    zones['non_residential_sqft'] = utils.grouped_sums(
+        codes, n, buildings.non_residential_sqft)
+
+    # the commercial types are segments, so the rent medians cover all of
+    # them at once (the sums are split back out by type so each keeps the
+    # dtype the groupby would give it)
+    types = ["Retail", "Office", "Industrial"]
+    codes = utils.group_codes(zones.index, buildings.zone_id,
+                              buildings.general_type, types)
+    for i, name in enumerate(['retail_sqft', 'office_sqft',
+                              'industrial_sqft']):
+        zones[name] = utils.grouped_sums(
+            np.where(codes % len(types) == i, codes // len(types), -1), n,
+            buildings.non_residential_sqft)
+    rent = utils.grouped_medians(
+        codes, n * len(types), buildings.non_residential_price,
+        approximate).reshape(n, len(types))
+
+    codes = utils.group_codes(zones.index, households.zone_id)
+    zones['average_income'] = utils.grouped_medians(
+        codes, n, households.income, approximate)
+    zones['household_size'] = utils.grouped_medians(
+        codes, n, households.persons, approximate)
+
+    codes = utils.group_codes(zones.index, buildings.zone_id,
+                              buildings.general_type, ["Residential"])
+    zones['building_count'] = utils.grouped_counts(codes, n)
+    zones['residential_price'] = utils.grouped_medians(
+        codes, n, buildings.residential_price, approximate)
+    zones['retail_rent'] = rent[:, 0]
+    zones['office_rent'] = rent[:, 1]
+    zones['industrial_rent'] = rent[:, 2]
 
     summary.add_zone_output(zones, "diagnostic_outputs", year)
+
+
+# profile the steps above (this only costs anything when profiling is
+# enabled)
+utils.profile_steps()
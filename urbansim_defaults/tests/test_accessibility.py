@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import orca
+import pandana as pdna
+import pandas as pd
+import pytest
+import yaml
+from urbansim.utils import networks
+
+from urbansim_defaults import utils
+
+
+def _variable(name, radius, **kwargs):
+    return dict(name=name, dataframe="buildings", radius=radius,
+                aggregation=kwargs.pop("aggregation", "sum"),
+                decay=kwargs.pop("decay", "linear"), **kwargs)
+
+
+@pytest.fixture
+def net(tmpdir, monkeypatch):
+    # a 10 by 10 grid of nodes 200 apart
+    rng = np.random.RandomState(0)
+    ids = np.arange(100)
+    right, down = ids[ids % 10 < 9], ids[ids < 90]
+    net = pdna.Network(
+        pd.Series(ids % 10 * 200., index=ids),
+        pd.Series(ids // 10 * 200., index=ids),
+        np.concatenate([right, down]), np.concatenate([right + 1, down + 10]),
+        pd.DataFrame({"weight": rng.uniform(200, 300, 180)}), twoway=True)
+    net.precompute(2000)
+
+    orca.add_table("buildings", pd.DataFrame({
+        "node_id": rng.choice(ids, 300),
+        "residential_units": rng.randint(0, 20, 300),
+        "stories": rng.randint(1, 10, 300),
+        "residential_price": rng.lognormal(6, .4, 300)
+    }))
+
+    monkeypatch.setenv("DATA_HOME", str(tmpdir))
+    os.makedirs(str(tmpdir.join("configs")))
+    variables = [
+        _variable("units", 1000, varname="residential_units"),
+        _variable("units_far", 2000, decay="flat",
+                  varname="residential_units"),
+        _variable("tall", 1000, aggregation="count", filters=["stories > 5"]),
+        _variable("price", 2000, aggregation="ave",
+                  varname="residential_price")
+    ]
+    for name, defs in [("a.yaml", variables[:2]), ("b.yaml", variables[2:])]:
+        with open(str(tmpdir.join("configs", name)), "w") as f:
+            yaml.dump({"node_col": "node_id", "variable_definitions": defs},
+                      f)
+    yield net
+    orca.clear_all()
+
+
+def test_fused_matches_from_yaml(net):
+    expected = pd.concat([networks.from_yaml(net, "a.yaml"),
+                          networks.from_yaml(net, "b.yaml")], axis=1)
+    actual = utils.accessibility_variables(net, ["a.yaml", "b.yaml"])
+    pd.testing.assert_frame_equal(actual, expected)
+
+
+def test_add_fields_are_read(net, tmpdir):
+    reads = []
+
+    @orca.column("buildings", "extra")
+    def extra(buildings):
+        reads.append(True)
+        return buildings.stories
+
+    with open(str(tmpdir.join("configs", "c.yaml")), "w") as f:
+        yaml.dump({"node_col": "node_id", "variable_definitions": [dict(
+            _variable("units", 1000, varname="residential_units"),
+            add_fields=["extra"])]}, f)
+    actual = utils.accessibility_variables(net, ["c.yaml"])
+    assert reads and list(actual.columns) == ["units"]
@@ -0,0 +1,84 @@
+import numpy as np
+import orca
+import pandas as pd
+import pytest
+
+from urbansim_defaults import utils
+
+
+@pytest.fixture
+def households():
+    # -1 is unplaced
+    orca.add_table("households", pd.DataFrame({
+        "building_id": np.random.RandomState(0).randint(-1, 40, 300)}))
+    yield orca.get_table("households")
+    orca.clear_all()
+    utils._OCCUPANCY.clear()
+
+
+def _counted(households):
+    counts = households.building_id.value_counts()
+    return counts[counts.index >= 0].sort_index()
+
+
+def test_occupancy_follows_relocations(households):
+    utils.occupancy_counts(households, "building_id")
+    moved = households.building_id[households.building_id >= 0].head(20)
+    locations = np.roll(moved.values, 1)
+    locations[:5] = -1
+    utils._relocate_agents(households, "building_id",
+                           pd.Series(locations, index=moved.index))
+    pd.testing.assert_series_equal(
+        utils.occupancy_counts(households, "building_id").sort_index(),
+        _counted(households), check_names=False)
+
+
+def test_occupancy_notices_writes_to_the_column(households):
+    utils.occupancy_counts(households, "building_id")
+    # written in place, so the frame is still the same object
+    utils.update_col_from_series(households, "building_id", pd.Series(
+        -1, index=households.index[:5]))
+    pd.testing.assert_series_equal(
+        utils.occupancy_counts(households, "building_id").sort_index(),
+        _counted(households), check_names=False)
+
+
+@pytest.fixture
+def buildings():
+    rng = np.random.RandomState(0)
+    orca.add_table("parcels", pd.DataFrame(index=np.arange(1, 51)))
+    orca.add_table("buildings", pd.DataFrame({
+        "parcel_id": rng.randint(1, 51, 40),
+        "residential_units": rng.randint(0, 20, 40)
+    }))
+    yield orca.get_table("buildings")
+    orca.clear_all()
+    utils._PARCEL_AGGREGATES.clear()
+
+
+def _aggregated(buildings):
+    return buildings.residential_units.groupby(buildings.parcel_id).sum().\
+        reindex(orca.get_table("parcels").index).fillna(0)
+
+
+def test_parcel_aggregate_is_a_copy(buildings):
+    parcels = orca.get_table("parcels")
+    values = utils.parcel_aggregate(parcels, buildings, "residential_units")
+    values[:] = -1
+    pd.testing.assert_series_equal(
+        utils.parcel_aggregate(parcels, buildings, "residential_units"),
+        _aggregated(buildings), check_names=False)
+
+
+@pytest.mark.parametrize("column", ["residential_units", "parcel_id"])
+def test_parcel_aggregate_notices_writes_to_the_column(buildings, column):
+    parcels = orca.get_table("parcels")
+    utils.parcel_aggregate(parcels, buildings, "residential_units")
+    # moves units between parcels without changing any of the totals'
+    # sums, and is written in place so the frame is the same object
+    written = buildings[column].iloc[:6]
+    utils.update_col_from_series(buildings, column, pd.Series(
+        np.roll(written.values, 1), index=written.index))
+    pd.testing.assert_series_equal(
+        utils.parcel_aggregate(parcels, buildings, "residential_units"),
+        _aggregated(buildings), check_names=False)
@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from urbansim_defaults import utils
+
+
+def test_count_nas():
+    df = pd.DataFrame({
+        "f": [1., np.nan, np.inf],
+        "i": [1, 2, 3],
+        "b": [True, False, True],
+        "o": ["a", None, "c"],
+        "ni": pd.array([1, None, 3], dtype="Int64"),
+        "nf": pd.array([1., None, 3.], dtype="Float64")
+    })
+    df.loc[2, "nf"] = np.inf
+    counts = utils._count_nas(df)
+    assert counts.to_dict() == {"f": 2, "i": 0, "b": 0, "o": 1, "ni": 1,
+                                "nf": 2}
+
+
+def test_check_nas_raises():
+    with pytest.raises(AssertionError):
+        utils.check_nas(pd.DataFrame({"a": [1., np.nan]}))
+    utils.check_nas(pd.DataFrame({"a": [1., np.nan]}), level="off")
+
+
+def test_sampled_leaves_global_random_state_alone(monkeypatch):
+    monkeypatch.setattr(utils, "_get_setting", lambda key, default=None:
+                        10 if key == "validation_sample_size" else default)
+    df = pd.DataFrame({"a": np.arange(1000.)})
+    np.random.seed(0)
+    expected = np.random.random_sample()
+    np.random.seed(0)
+    utils.check_nas(df, level="sampled")
+    assert np.random.random_sample() == expected
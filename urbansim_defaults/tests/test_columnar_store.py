@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from urbansim_defaults import utils
+
+
+@pytest.fixture
+def store(tmpdir):
+    df = pd.DataFrame({
+        "index": np.arange(5.),
+        "a": np.arange(5),
+        "b": np.arange(5.) * 2,
+        "s": list("abcde")
+    }, index=pd.Index(np.arange(10, 15), name="building_id"))
+    hdf_path = str(tmpdir.join("store.h5"))
+    df.to_hdf(hdf_path, "buildings")
+    path = str(tmpdir.join("columnar"))
+    utils.write_columnar_store(hdf_path, path)
+    return df, hdf_path, path
+
+
+def test_round_trip(store):
+    df, hdf_path, path = store
+    assert utils.columnar_store_is_current(hdf_path, path)
+    pd.testing.assert_frame_equal(utils.ColumnarStore(path)["buildings"], df)
+
+
+def test_columns_stay_mapped(store):
+    _, _, path = store
+    df = utils.ColumnarStore(path)["buildings"]
+    numeric = [b for b in df._mgr.blocks if b.dtype != object]
+    assert len(numeric) == 3
+    assert all(isinstance(b.values, np.memmap) for b in numeric)
+
+
+def test_index_and_column_named_index(store):
+    df, _, path = store
+    s = utils.ColumnarStore(path)
+    pd.testing.assert_index_equal(s.select_index("buildings"), df.index)
+    np.testing.assert_array_equal(
+        s.select_column("buildings", "index").values, df["index"].values)
+    np.testing.assert_array_equal(
+        utils.read_index(s, "buildings"), df.index.values)
+
+
+def test_select_columns(store):
+    df, _, path = store
+    s = utils.ColumnarStore(path, columns={"buildings": ["a"]})
+    pd.testing.assert_frame_equal(s["buildings"], df[["a"]])
+    pd.testing.assert_frame_equal(s.select("buildings", columns=["b"]),
+                                  df[["b"]])
+
+
+@pytest.mark.parametrize("fmt", ["fixed", "table"])
+def test_read_index_from_hdf(tmpdir, fmt):
+    df = pd.DataFrame({"a": np.arange(5)},
+                      index=pd.Index(np.arange(10, 15), name="building_id"))
+    path = str(tmpdir.join("store.h5"))
+    df.to_hdf(path, "buildings", format=fmt)
+    df.a.to_hdf(path, "units", format=fmt)
+    with pd.HDFStore(path, "r") as store:
+        for key in ["buildings", "units"]:
+            np.testing.assert_array_equal(utils.read_index(store, key),
+                                          df.index.values)
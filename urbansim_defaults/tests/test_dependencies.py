@@ -0,0 +1,87 @@
+import numpy as np
+import orca
+import pandas as pd
+import pytest
+
+from urbansim_defaults import utils
+
+
+@pytest.fixture
+def tables():
+    orca.add_table("parcels", pd.DataFrame(
+        {"x": np.arange(3), "y": np.arange(3)}))
+    orca.add_table("zones", pd.DataFrame({"z": np.arange(3)}))
+
+    @orca.column("parcels", "x2", cache=True)
+    def x2(parcels):
+        return parcels.x * 2
+
+    @orca.column("parcels", "position", cache=True)
+    def position(parcels):
+        return pd.Series(np.arange(len(parcels)), index=parcels.index)
+
+    @orca.column("parcels", "total", cache=True)
+    def total(parcels):
+        return parcels.local.sum(axis=1)
+
+    @orca.column("parcels", "looked_up", cache=True)
+    def looked_up(parcels):
+        return orca.get_table("zones").z
+
+    utils.track_column_dependencies()
+    for c in ["x2", "position", "total", "looked_up"]:
+        orca.get_table("parcels")[c]
+    yield
+    orca.clear_all()
+    utils._COLUMN_DEPENDENCIES.clear()
+
+
+def test_wrapped_functions_keep_their_names(tables):
+    assert orca.get_raw_column("parcels", "x2")._func.__name__ == "x2"
+
+
+def test_written_columns_clear_their_readers(tables):
+    assert utils.dependent_columns("parcels", ["x"]) == {
+        ("parcels", "x2"), ("parcels", "total"), ("parcels", "looked_up")}
+    assert utils.dependent_columns("parcels", ["y"]) == {
+        ("parcels", "total"), ("parcels", "looked_up")}
+    # columns which look tables up themselves might read anything
+    assert utils.dependent_columns("zones", ["z"]) == {
+        ("parcels", "looked_up")}
+
+
+def test_replaced_tables_clear_index_readers(tables):
+    assert ("parcels", "position") in utils.dependent_columns("parcels")
+
+
+@pytest.fixture
+def aggregated():
+    orca.add_table("parcels", pd.DataFrame(index=np.arange(1, 4)))
+    orca.add_table("buildings", pd.DataFrame({
+        "parcel_id": [1, 1, 3],
+        "residential_units": [2, 3, 4],
+        "residential_price": [100., 200., 300.]}))
+
+    @orca.column("parcels", "total_residential_units", cache=True)
+    def total_residential_units(parcels, buildings):
+        return utils.parcel_aggregate(parcels, buildings, "residential_units")
+
+    utils.track_column_dependencies()
+    orca.get_table("parcels").total_residential_units
+    yield
+    orca.clear_all()
+    utils._COLUMN_DEPENDENCIES.clear()
+    utils._PARCEL_AGGREGATES.clear()
+
+
+def test_helpers_record_only_the_columns_they_use(aggregated):
+    buildings = orca.get_table("buildings")
+    assert utils.dependent_columns("buildings", ["residential_price"]) == set()
+    utils.update_col_from_series(
+        buildings, "residential_price", pd.Series([1.], index=[0]))
+    assert ("parcels", "total_residential_units") in orca.orca._COLUMN_CACHE
+
+    utils.update_col_from_series(
+        buildings, "residential_units", pd.Series([5], index=[0]))
+    assert orca.get_table("parcels").total_residential_units.tolist() == \
+        [8, 0, 4]
@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import orca
+import pandas as pd
+import pytest
+from urbansim.models import RegressionModel
+
+from urbansim_defaults import utils
+
+EXPRESSION = "np.log(residential_price) ~ np.log1p(stories) + year_built"
+
+
+@pytest.fixture
+def data_home(tmpdir, monkeypatch):
+    monkeypatch.setenv("DATA_HOME", str(tmpdir))
+    os.makedirs(str(tmpdir.join("configs")))
+    os.makedirs(str(tmpdir.join("data")))
+    RegressionModel(["stories > 0"], ["stories > 0"], EXPRESSION).to_yaml(
+        str_or_buffer=str(tmpdir.join("configs", "rsh.yaml")))
+
+    rng = np.random.RandomState(0)
+    orca.add_table("buildings", pd.DataFrame({
+        "stories": rng.randint(1, 10, 300),
+        "year_built": rng.randint(1900, 2010, 300),
+        "residential_price": rng.lognormal(6, .4, 300)
+    }))
+    orca.add_injectable("settings", {"estimation_cache": True})
+    yield tmpdir
+    orca.clear_all()
+    utils.clear_model_cache()
+
+
+def test_cached_fit_is_reported(data_home, capsys):
+    fitted = utils.hedonic_estimate(
+        "rsh.yaml", orca.get_table("buildings"), [])
+    assert "Using the cached fit" not in capsys.readouterr().out
+    cached = utils.hedonic_estimate(
+        "rsh.yaml", orca.get_table("buildings"), [])
+    second = capsys.readouterr().out
+
+    assert "Using the cached fit of rsh.yaml" in second
+    assert "R-Squared" in second
+    assert cached.fit_parameters.equals(fitted.fit_parameters)
+    # the cache holds whole files only
+    cache_dir = data_home.join("data", "estimation_cache")
+    assert all(f.endswith(".yaml") for f in os.listdir(str(cache_dir)))
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from urbansim_defaults import utils
+
+TYPES = {1: "Residential", 2: "Residential", 3: "Retail", 4: "Office",
+         5: "Industrial"}
+
+
+@pytest.fixture
+def buildings():
+    rng = np.random.RandomState(0)
+    n = 2000
+    df = pd.DataFrame({
+        "zone_id": rng.randint(1, 10, n),
+        "general_type": pd.Series(rng.randint(1, 6, n)).map(TYPES).values,
+        "residential_units": rng.randint(0, 20, n),
+        "residential_price": rng.lognormal(6, .4, n),
+        "non_residential_price": rng.lognormal(3.4, .4, n)
+    }, index=pd.Index(np.arange(1, n + 1), name="building_id"))
+    df.loc[df.index[::7], "residential_price"] = np.nan
+    return df
+
+
+@pytest.fixture(params=[0, 1], ids=["all_zones", "empty_zone"])
+def zones(request, buildings):
+    # a zone without buildings turns the groupby results into floats
+    ids = np.arange(1, buildings.zone_id.max() + 1 + request.param)
+    return pd.DataFrame(index=pd.Index(ids, name="zone_id"))
+
+
+def test_grouped_matches_groupby(buildings, zones):
+    codes = utils.group_codes(zones.index, buildings.zone_id)
+    n = len(zones)
+
+    expected = zones.copy()
+    expected["units"] = buildings.groupby("zone_id").residential_units.sum()
+    expected["count"] = buildings.groupby("zone_id").size()
+    expected["price"] = buildings.groupby("zone_id").\
+        residential_price.quantile()
+
+    actual = zones.copy()
+    actual["units"] = utils.grouped_sums(
+        codes, n, buildings.residential_units)
+    actual["count"] = utils.grouped_counts(codes, n)
+    actual["price"] = utils.grouped_medians(
+        codes, n, buildings.residential_price)
+
+    pd.testing.assert_frame_equal(actual, expected)
+
+
+def test_segmented_medians_match_groupby(buildings, zones):
+    types = ["Retail", "Office", "Industrial"]
+    codes = utils.group_codes(zones.index, buildings.zone_id,
+                              buildings.general_type, types)
+    rent = utils.grouped_medians(
+        codes, len(zones) * len(types), buildings.non_residential_price).\
+        reshape(len(zones), len(types))
+
+    for i, t in enumerate(types):
+        expected = buildings[buildings.general_type == t].\
+            groupby("zone_id").non_residential_price.quantile().\
+            reindex(zones.index)
+        np.testing.assert_allclose(rent[:, i], expected.values)
+
+
+@pytest.mark.parametrize("sigma", [.4, 2.])
+def test_approximate_medians(sigma):
+    # each group is binned over its own range, so skewed values in one
+    # group don't cost the others their resolution
+    rng = np.random.RandomState(0)
+    codes = rng.randint(-1, 50, 100000)
+    values = rng.lognormal(11, sigma, len(codes))
+    values[codes == 3] *= 1000
+    values[codes == 4] = 7.
+    exact = utils.grouped_medians(codes, 52, values)
+    approx = utils.grouped_medians(codes, 52, values, approximate=True,
+                                   chunksize=7000)
+
+    np.testing.assert_allclose(approx, exact, rtol=.01)
+    assert approx[4] == 7.
+    assert np.isnan(approx[50:]).all()
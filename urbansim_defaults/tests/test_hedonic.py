@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+import pytest
+from urbansim.models import RegressionModel, SegmentedRegressionModel
+
+from urbansim_defaults import utils
+
+EXPRESSION = "np.log(residential_price) ~ C(building_type_id) + " \
+    "np.log1p(stories) + year_built"
+
+
+@pytest.fixture
+def buildings():
+    rng = np.random.RandomState(0)
+    n = 500
+    return pd.DataFrame({
+        "building_type_id": rng.choice([1, 2, 3, 4, 5], n,
+                                       p=[.5, .2, .1, .1, .1]),
+        "stories": rng.randint(1, 10, n),
+        "year_built": rng.randint(1900, 2010, n),
+        "residential_price": rng.lognormal(6, .4, n)
+    }, index=pd.Index(np.arange(1, n + 1), name="building_id"))
+
+
+def _from_yaml(model):
+    # a model loaded from yaml predicts like the ones the simulation uses
+    return type(model).from_yaml(yaml_str=model.to_yaml())
+
+
+@pytest.fixture
+def hedonic(buildings):
+    hm = RegressionModel(["stories > 0"], ["stories > 0"], EXPRESSION,
+                         ytransform=np.exp)
+    hm.fit(buildings)
+    return _from_yaml(hm)
+
+
+@pytest.fixture
+def segmented(buildings):
+    hm = SegmentedRegressionModel(
+        "stories", fit_filters=["stories < 8"], predict_filters=["stories < 8"],
+        default_model_expr=EXPRESSION, default_ytransform=np.exp)
+    hm.fit(buildings)
+    return _from_yaml(hm)
+
+
+@pytest.fixture
+def hedonic_cfg(tmpdir, hedonic):
+    cfg = str(tmpdir.join("hedonic.yaml"))
+    hedonic.to_yaml(str_or_buffer=cfg)
+    utils._HEDONIC_PREDICTIONS.clear()
+    return cfg
+
+
+@pytest.mark.parametrize("model", ["hedonic", "segmented"])
+@pytest.mark.parametrize("chunksize, workers", [
+    (7, None), (100, None), (None, 2), (50, 3)])
+def test_hedonic_predict_matches_one_shot(request, buildings, model,
+                                          chunksize, workers):
+    hm = request.getfixturevalue(model)
+    expected = hm.predict(buildings)
+    result = utils._hedonic_predict(hm, buildings, chunksize, workers)
+    pd.testing.assert_series_equal(result.loc[expected.index], expected)
+    assert len(result) == len(expected)
+
+
+def test_hedonic_predict_block_missing_a_level(hedonic, buildings):
+    # the first block only has one building type, so its own design matrix
+    # wouldn't line up with the coefficients
+    buildings = buildings.sort_values("building_type_id")
+    expected = hedonic.predict(buildings)
+    result = utils._hedonic_predict(hedonic, buildings, chunksize=10)
+    pd.testing.assert_series_equal(result, expected)
+
+
+def _incremental(cfg, df):
+    return utils._incremental_hedonic_predict(cfg, "key", df, chunksize=64)
+
+
+def test_incremental_matches_full_predict(hedonic_cfg, hedonic, buildings):
+    first = _incremental(hedonic_cfg, buildings)
+    pd.testing.assert_series_equal(first, hedonic.predict(buildings))
+
+    # a few buildings change, some are demolished and some are new
+    df = buildings.copy()
+    df.loc[df.index[:5], "stories"] += 1
+    df.loc[df.index[5:8], "building_type_id"] = 3
+    df = df.drop(df.index[10:20])
+    new = buildings.iloc[20:30].copy()
+    new.index = new.index + buildings.index.max()
+    df = pd.concat([df, new])
+
+    result = _incremental(hedonic_cfg, df)
+    expected = hedonic.predict(df)
+    pd.testing.assert_series_equal(result.loc[expected.index], expected)
+    assert len(result) == len(expected)
+
+
+def test_incremental_stateful_transform(tmpdir, buildings):
+    # centering depends on every row, so every row is predicted again
+    hm = RegressionModel(None, None, EXPRESSION + " + center(stories)",
+                         ytransform=np.exp)
+    hm.fit(buildings)
+    hm = _from_yaml(hm)
+    cfg = str(tmpdir.join("centered.yaml"))
+    hm.to_yaml(str_or_buffer=cfg)
+    utils._HEDONIC_PREDICTIONS.clear()
+
+    _incremental(cfg, buildings)
+    df = buildings.copy()
+    df.loc[df.index[:50], "stories"] += 3
+    pd.testing.assert_series_equal(_incremental(cfg, df), hm.predict(df))
+
+
+def test_incremental_only_predicts_changed_rows(hedonic_cfg, buildings,
+                                                monkeypatch):
+    _incremental(hedonic_cfg, buildings)
+    df = buildings.copy()
+    df.loc[df.index[:3], "stories"] += 1
+
+    predicted = []
+    segment = utils._regression_segment
+    monkeypatch.setattr(utils, "_regression_segment",
+                        lambda task: predicted.append(len(task[1])) or
+                        segment(task))
+    _incremental(hedonic_cfg, df)
+    assert sum(predicted) == 3
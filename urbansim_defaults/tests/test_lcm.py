@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+from urbansim.models import MNLDiscreteChoiceModel, \
+    SegmentedMNLDiscreteChoiceModel
+
+from urbansim_defaults import utils
+
+EXPRESSION = "np.log1p(residential_units) + stories - 1"
+
+
+@pytest.fixture
+def region():
+    rng = np.random.RandomState(0)
+    buildings = pd.DataFrame({
+        "residential_units": rng.randint(5, 15, 40),
+        "stories": rng.randint(1, 10, 40)
+    }, index=pd.Index(np.arange(1, 41), name="building_id"))
+    # most households are in a unit and the rest are unplaced
+    units = np.repeat(buildings.index.values, buildings.residential_units)
+    building_id = np.full(300, -1)
+    building_id[:270] = rng.permutation(units)[:270]
+    households = pd.DataFrame({
+        "building_id": rng.permutation(building_id),
+        "tenure": rng.randint(1, 3, 300)
+    }, index=pd.Index(np.arange(1, 301), name="household_id"))
+    return buildings, households
+
+
+def _lcm(buildings, households, **modes):
+    lcm = MNLDiscreteChoiceModel(EXPRESSION, 10, **modes)
+    np.random.seed(0)
+    lcm.fit(households[households.building_id > 0], buildings, "building_id")
+    return lcm
+
+
+def _unit_predict(lcm, choosers, buildings, capacity):
+    # the unit-level alternatives lcm_simulate builds without
+    # capacity_weighted
+    units = buildings.loc[np.repeat(capacity.index.values,
+                                    capacity.values)].reset_index()
+    choices = utils._lcm_predict(lcm, choosers, units, alternative_ratio=1e9)
+    choices = choices.dropna()
+    return pd.Series(units.building_id.loc[choices.values].values,
+                     index=choices.index)
+
+
+def test_capacity_weighted_matches_units(region):
+    buildings, households = region
+    lcm = _lcm(buildings, households, probability_mode="single_chooser",
+               choice_mode="aggregate")
+    capacity = pd.Series(np.random.RandomState(1).randint(
+        1, 4, len(buildings)), index=buildings.index)
+    choosers = households.head(int(capacity.sum() * .6))
+
+    np.random.seed(0)
+    by_units, by_buildings = [], []
+    for _ in range(300):
+        by_units.append(_unit_predict(lcm, choosers, buildings, capacity).
+                        value_counts().reindex(capacity.index).fillna(0))
+        placed = utils._capacity_weighted_predict(
+            lcm, choosers, buildings, capacity).dropna().value_counts().\
+            reindex(capacity.index).fillna(0)
+        assert (placed <= capacity).all()
+        assert placed.sum() == len(choosers)
+        by_buildings.append(placed)
+
+    # the same number of choosers lands in each building on average (only
+    # spreading them by capacity would be off by about .2)
+    by_units = pd.concat(by_units, axis=1).mean(axis=1)
+    by_buildings = pd.concat(by_buildings, axis=1).mean(axis=1)
+    assert (by_buildings - by_units).abs().mean() < .1
+
+
+def test_capacity_weighted_needs_aggregate_choices(region):
+    buildings, households = region
+    lcm = _lcm(buildings, households)
+    capacity = pd.Series(1, index=buildings.index)
+    with pytest.raises(AssertionError):
+        utils._capacity_weighted_predict(lcm, households, buildings, capacity)
+
+
+@pytest.mark.parametrize("remove_alts", [False, True])
+@pytest.mark.parametrize("modes", [("single_chooser", "aggregate"),
+                                   ("full_product", "individual")])
+def test_parallel_segments_match_serial(region, modes, remove_alts):
+    buildings, households = region
+    lcm = SegmentedMNLDiscreteChoiceModel(
+        "tenure", 10, probability_mode=modes[0], choice_mode=modes[1],
+        default_model_expr=EXPRESSION, remove_alts=remove_alts)
+    np.random.seed(0)
+    lcm.fit(households[households.building_id > 0], buildings, "building_id")
+    units = buildings.loc[np.repeat(
+        buildings.index.values, buildings.residential_units.values)].\
+        reset_index()
+    choosers = households.head(80)
+
+    np.random.seed(1)
+    serial = utils._lcm_predict(lcm, choosers, units, 1e9)
+    np.random.seed(1)
+    parallel = utils._lcm_predict(lcm, choosers, units, 1e9, workers=2)
+    pd.testing.assert_series_equal(parallel, serial)
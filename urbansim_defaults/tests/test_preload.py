@@ -0,0 +1,84 @@
+import numpy as np
+import orca
+import pandas as pd
+import pytest
+
+from urbansim_defaults import utils
+
+CALLS = {}
+
+
+@pytest.fixture
+def tables():
+    CALLS.update(parcels=0, buildings=0)
+
+    @orca.table("parcels", cache=True)
+    def parcels():
+        CALLS["parcels"] += 1
+        return pd.DataFrame({"x": np.arange(3)})
+
+    @orca.table("buildings", cache=True)
+    def buildings(parcels):
+        CALLS["buildings"] += 1
+        return pd.DataFrame({"y": parcels.x * 2})
+
+    yield
+    orca.clear_all()
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_preloaded_tables_reload(tables, executor):
+    assert utils._table_arguments("buildings") == ["parcels"]
+    utils.preload_tables(["buildings", "parcels"], 2, executor)
+    assert orca.table_type("parcels") == "function"
+    assert orca.get_table("buildings").y.tolist() == [0, 2, 4]
+    # parcels were loaded once, in a worker process or in this one
+    loaded_here = 1 if executor == "thread" else 0
+    assert CALLS == {"buildings": 1, "parcels": loaded_here}
+
+    orca.clear_cache()
+    assert orca.get_table("buildings").y.tolist() == [0, 2, 4]
+    assert CALLS == {"buildings": 2, "parcels": loaded_here + 1}
+
+
+@pytest.fixture
+def stored(tmpdir):
+    path = str(tmpdir.join("store.h5"))
+    pd.DataFrame({"x": np.arange(3)}, index=[5, 6, 7]).to_hdf(path, "parcels")
+    CALLS.update(store_ids=0)
+
+    @orca.injectable("store", cache=True)
+    def store():
+        return pd.HDFStore(path, mode="r")
+
+    @orca.injectable("store_ids", cache=True)
+    def store_ids(store):
+        CALLS["store_ids"] += 1
+        return utils.read_index(store, "parcels")
+
+    @orca.table("parcels", cache=True)
+    def parcels(store, store_ids):
+        return store["parcels"].loc[store_ids]
+
+    @orca.table("zones", cache=True)
+    def zones(store_ids):
+        return pd.DataFrame(index=store_ids)
+
+    yield
+    orca.get_injectable("store").close()
+    orca.clear_all()
+
+
+def test_store_is_restored(stored):
+    raw = orca.get_raw_injectable("store")
+    utils.preload_tables(["parcels", "zones"], 2)
+    assert orca.get_raw_injectable("store") is raw
+    assert isinstance(orca.get_injectable("store"), pd.HDFStore)
+    # resolved once before the workers start
+    assert CALLS["store_ids"] == 1
+    assert orca.get_table("parcels").index.tolist() == [5, 6, 7]
+
+
+def test_locked_store_reads_indexes(stored):
+    store = utils._LockedStore(orca.get_injectable("store"))
+    assert utils.read_index(store, "parcels").tolist() == [5, 6, 7]
@@ -1,13 +1,23 @@
 from __future__ import print_function
 
+import contextlib
+import functools
+import hashlib
 import json
+import multiprocessing
+import os
+import time
 
 import orca
 import numpy as np
 import pandas as pd
+import patsy
 from urbansim.models import RegressionModel, SegmentedRegressionModel, \
     MNLDiscreteChoiceModel, SegmentedMNLDiscreteChoiceModel, \
     GrowthRateTransition, transition
+from urbansim.models import util
+from urbansim.models.regression import ModelEvaluationError
+from urbansim.models.dcm import unit_choice
 from urbansim.models.supplydemand import supply_and_demand
 from urbansim.developer import sqftproforma, developer
 from urbansim.utils import misc
@@ -61,7 +71,827 @@ def enable_logging():
     logutil.log_to_stream()
 
 
-def check_nas(df):
+def _get_setting(key, default=None):
+    """
+    Read an optional key from the settings injectable, returning the default
+    if there are no settings registered (e.g. when utils is used on its own)
+    """
+    if not orca.is_injectable("settings"):
+        return default
+    return orca.get_injectable("settings").get(key, default)
+
+
+def _iter_var():
+    if not orca.is_injectable("iter_var"):
+        return None
+    return orca.get_injectable("iter_var")
+
+
+# what was recorded while profiling - one record per orca step and per call
+# to a helper in this module, see enable_profiling and write_run_report
+_PROFILE = {
+    "enabled": False,
+    "open": [],
+    "records": [],
+    "written_year": None,
+    "atexit": False
+}
+
+
+def enable_profiling(enabled=True, memory=False):
+    """
+    Record the wall time, CPU time, change in resident memory and rows
+    processed for every orca step and every helper in this module which is
+    decorated with profiled.  Profiling is also enabled by setting profile
+    to True in the settings.  While it is enabled the run report is written
+    at the end of each simulated year and when the process exits, see
+    write_run_report.
+
+    Parameters
+    ----------
+    enabled : boolean, optional
+        Turn profiling on or off
+    memory : boolean, optional
+        Also record the peak memory allocated during each step and helper,
+        by tracing allocations with tracemalloc - which slows the run down,
+        so it is off by default
+
+    Returns
+    -------
+    Nothing
+    """
+    _PROFILE["enabled"] = enabled
+    if memory and enabled:
+        import tracemalloc
+        tracemalloc.start()
+    profile_steps()
+
+
+def _profiling():
+    return _PROFILE["enabled"] or _get_setting("profile", False)
+
+
+def _current_rss():
+    """
+    The resident memory of this process in bytes, or None where it can't be
+    read cheaply.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def _tracing_memory():
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    if not tracemalloc.is_tracing() or \
+            not hasattr(tracemalloc, "reset_peak"):
+        return None
+    return tracemalloc
+
+
+def _start_peak(record):
+    """
+    Start measuring the peak memory allocated in a block.  The tracer only
+    has one peak, so the peak reached so far in the enclosing block is
+    saved in its record before the peak is reset for this one.
+    """
+    tracemalloc = _tracing_memory()
+    if tracemalloc is None:
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    if _PROFILE["open"]:
+        outer = _PROFILE["open"][-1]
+        outer["_peak"] = max(outer.get("_peak", 0), peak)
+    tracemalloc.reset_peak()
+    record["_start"] = current
+
+
+def _end_peak(record):
+    tracemalloc = _tracing_memory()
+    if tracemalloc is None or "_start" not in record:
+        return
+    peak = max(record.pop("_peak", 0), tracemalloc.get_traced_memory()[1])
+    record["peak_memory"] = peak - record.pop("_start")
+    # the enclosing block's peak includes this one's
+    if _PROFILE["open"]:
+        outer = _PROFILE["open"][-1]
+        outer["_peak"] = max(outer.get("_peak", 0), peak)
+
+
+def _cpu_time():
+    return time.process_time() if hasattr(time, "process_time") \
+        else time.clock()
+
+
+def _current_step():
+    if not orca.is_injectable("iter_step"):
+        return None
+    return orca.get_injectable("iter_step").step_name
+
+
+@contextlib.contextmanager
+def profile(name, kind="helper"):
+    """
+    Time a block of code when profiling is enabled, adding a record to the
+    run report.  The record is yielded so the block can add to it, e.g. the
+    number of rows it processed.
+
+    The record has the "wall_time" and "cpu_time" of the block and the
+    change in the resident memory of the process over it ("rss_delta",
+    which is negative when memory was freed).  When memory profiling is
+    enabled it also has the peak memory allocated during the block, above
+    what was allocated when it started ("peak_memory").
+
+    Parameters
+    ----------
+    name : str
+        The name of the step or helper
+    kind : str, optional
+        "step" or "helper"
+
+    Returns
+    -------
+    A context manager yielding the record (a dict)
+    """
+    if not _profiling():
+        yield {}
+        return
+
+    record = {
+        "name": name,
+        "kind": kind,
+        "year": _iter_var(),
+        "step": _current_step(),
+        "depth": len(_PROFILE["open"]),
+        "rows": None
+    }
+    _start_peak(record)
+    start, cpu_start, rss_start = time.time(), _cpu_time(), _current_rss()
+    _PROFILE["open"].append(record)
+    try:
+        yield record
+    finally:
+        _PROFILE["open"].pop()
+        record["wall_time"] = time.time() - start
+        record["cpu_time"] = _cpu_time() - cpu_start
+        rss = _current_rss()
+        record["rss_delta"] = None if rss is None or rss_start is None \
+            else rss - rss_start
+        _end_peak(record)
+        _PROFILE["records"].append(record)
+
+
+def _profile_detail(detail):
+    """
+    Add the detail (a dict) to the record of the innermost step or helper
+    being profiled, if profiling is enabled.
+    """
+    if _PROFILE["open"]:
+        _PROFILE["open"][-1]["detail"] = detail
+
+
+class _Phases(object):
+    """
+    Time consecutive phases of a function - each call to lap ends the
+    current phase and starts the next one.
+    """
+    def __init__(self):
+        self.times = {}
+        self._wall, self._cpu = time.time(), _cpu_time()
+
+    def lap(self, name):
+        wall, cpu = time.time(), _cpu_time()
+        t = self.times.setdefault(name, {"wall_time": 0.0, "cpu_time": 0.0})
+        t["wall_time"] += wall - self._wall
+        t["cpu_time"] += cpu - self._cpu
+        self._wall, self._cpu = wall, cpu
+
+
+def _rows(args):
+    for arg in args:
+        if isinstance(arg, (pd.DataFrame, pd.Series, orca.DataFrameWrapper)):
+            return len(arg)
+    return None
+
+
+def profiled(func):
+    """
+    Decorator which profiles each call to a helper when profiling is
+    enabled - the rows processed are the length of the first table passed.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _profiling():
+            return func(*args, **kwargs)
+        with profile(func.__name__) as record:
+            record["rows"] = _rows(list(args) + list(kwargs.values()))
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _write_run_report_safely():
+    try:
+        write_run_report()
+    except (IOError, OSError) as e:
+        print("WARNING: could not write the run report: %s" % e)
+
+
+def _profiled_step(step_name, func):
+    @functools.wraps(func)
+    def wrapper(**kwargs):
+        if not _profiling():
+            return func(**kwargs)
+
+        # the report is written once a year has finished (and when the
+        # process exits) rather than after every step
+        if not _PROFILE["atexit"]:
+            import atexit
+            atexit.register(_write_run_report_safely)
+            _PROFILE["atexit"] = True
+        year = _iter_var()
+        if _PROFILE["records"] and _PROFILE["written_year"] != year:
+            _write_run_report_safely()
+        _PROFILE["written_year"] = year
+
+        with profile(step_name, kind="step"):
+            return func(**kwargs)
+    wrapper._profiled = True
+    return wrapper
+
+
+def profile_steps():
+    """
+    Profile every orca step registered so far - models.py calls this once
+    its steps are registered, and enable_profiling calls it again to pick up
+    steps registered elsewhere (it is safe to call more than once).
+
+    Returns
+    -------
+    Nothing
+    """
+    for step_name, step in orca.orca._STEPS.items():
+        func = getattr(step, "_func", None)
+        if func is None or getattr(func, "_profiled", False):
+            continue
+        # orca calls the function with keyword arguments collected from the
+        # argspec it took at registration, so it can be wrapped in place
+        step._func = _profiled_step(step_name, func)
+
+
+def run_report():
+    """
+    Summarize what was recorded while profiling.
+
+    Returns
+    -------
+    A dict with all the "records" and a "years" summary, which holds the
+    total wall time, CPU time and change in resident memory of each step in
+    each year, and the highest peak memory if memory profiling is enabled
+    """
+    years = {}
+    for r in _PROFILE["records"]:
+        if r["kind"] != "step":
+            continue
+        step = years.setdefault(str(r["year"]), {}).setdefault(r["name"], {
+            "calls": 0, "wall_time": 0.0, "cpu_time": 0.0,
+            "rss_delta": 0
+        })
+        step["calls"] += 1
+        step["wall_time"] += r["wall_time"]
+        step["cpu_time"] += r["cpu_time"]
+        step["rss_delta"] += r["rss_delta"] or 0
+        if r.get("peak_memory") is not None:
+            step["peak_memory"] = max(step.get("peak_memory", 0),
+                                      r["peak_memory"])
+    return {"records": _PROFILE["records"], "years": years}
+
+
+def write_run_report(filename=None):
+    """
+    Write the run report (see run_report) as json next to the other run
+    outputs.
+
+    Parameters
+    ----------
+    filename : str, optional
+        Where to write the report.  Defaults to run{}_profile.json with the
+        run number filled in, in the runs directory.
+
+    Returns
+    -------
+    Nothing
+    """
+    if filename is None:
+        run_number = orca.get_injectable("run_number") \
+            if orca.is_injectable("run_number") else ""
+        filename = os.path.join(misc.runs_dir(),
+                                "run{}_profile.json".format(run_number))
+    with open(filename, "w") as f:
+        json.dump(run_report(), f, default=str)
+
+
+# how many random streams each helper has taken in each step, so that the
+# streams of repeated calls in a step are different but reproducible
+_RANDOM_STREAMS = {}
+
+
+def _hash_seed(key):
+    # python's hash() of strings changes from process to process, so hash
+    # the key with hashlib to get the same seed everywhere
+    digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+    return int(digest[:8], 16)
+
+
+def random_state(name):
+    """
+    Get the random number generator for a helper.  When the random_seed
+    setting is given each helper gets an independent stream, seeded from
+    the setting, the run number, the year, the running step and the name of
+    the helper (and how many streams it has already taken in the step), so
+    the numbers it draws don't depend on which steps ran before it, or in
+    which process - a step run on its own, or in parallel with others, gives
+    bit-identical results.
+
+    Parameters
+    ----------
+    name : str
+        The name of the helper
+
+    Returns
+    -------
+    A numpy RandomState, or None if there's no random_seed setting
+    """
+    seed = _get_setting("random_seed", None)
+    if seed is None:
+        return None
+    run_number = orca.get_injectable("run_number") \
+        if orca.is_injectable("run_number") else None
+    key = (seed, run_number, _iter_var(), _current_step(), name)
+    calls = _RANDOM_STREAMS.get(key, 0)
+    _RANDOM_STREAMS[key] = calls + 1
+    return np.random.RandomState(_hash_seed(key + (calls,)))
+
+
+def seeded(func):
+    """
+    Decorator which runs a helper with numpy's global random state seeded
+    from the helper's stream (see random_state), restoring the global state
+    afterwards.  urbansim's models draw from the global state, so this is
+    how their draws are made reproducible too.  Without the random_seed
+    setting the helper draws from the global state as before.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        rng = random_state(func.__name__)
+        if rng is None:
+            return func(*args, **kwargs)
+        state = np.random.get_state()
+        np.random.set_state(rng.get_state())
+        try:
+            return func(*args, **kwargs)
+        finally:
+            np.random.set_state(state)
+    return wrapper
+
+
+def update_col_from_series(tbl, column_name, series, cast=False):
+    """
+    Update existing values in a column of an orca table.  This is the same
+    as DataFrameWrapper.update_col_from_series but also lets the caches in
+    this module know that the column has changed - all writes in this module
+    go through here.
+
+    Parameters
+    ----------
+    tbl : DataFrameWrapper
+        The table to update
+    column_name : str
+        The column to update
+    series : Series
+        The new values, indexed like tbl
+    cast : boolean
+        Should the series be cast to match the existing column.
+
+    Returns
+    -------
+    Nothing
+    """
+    tbl.update_col_from_series(column_name, series, cast=cast)
+    _table_changed(tbl.name, [column_name])
+
+
+def add_table(table_name, df):
+    """
+    Register a DataFrame with orca, replacing any table with the same name.
+    This is the same as orca.add_table but also lets the caches in this
+    module know that the table has changed - all tables replaced in this
+    module go through here.
+
+    Parameters
+    ----------
+    table_name : str
+        The name of the table
+    df : DataFrame
+        The new table
+
+    Returns
+    -------
+    The DataFrameWrapper that was registered
+    """
+    tbl = orca.add_table(table_name, df)
+    _table_changed(table_name)
+    return tbl
+
+
+def _table_changed(table_name, columns=None):
+    """
+    Drop anything cached in this module or by orca which was computed from
+    the given table - including the cached computed columns which read the
+    changed columns, directly or through other computed columns.  If columns
+    is None the whole table was replaced.
+    """
+    changed = {table_name: None if columns is None else set(columns)}
+    for t, c in dependent_columns(table_name, columns):
+        orca.get_raw_column(t, c).clear_cached()
+        if changed.get(t, set()) is not None:
+            changed.setdefault(t, set()).add(c)
+
+    for t, cols in changed.items():
+        invalidate_frame_cache(t, cols)
+        for key in list(_OCCUPANCY):
+            if key[0] == t and (cols is None or key[1] in cols):
+                del _OCCUPANCY[key]
+        if t == "buildings" and cols is not None:
+            for key in list(_PARCEL_AGGREGATES):
+                if set([_PARCEL_AGGREGATES[key]["column"], "parcel_id"]) & cols:
+                    del _PARCEL_AGGREGATES[key]
+
+
+# the columns each computed column read the last times it was computed, keyed
+# by (table name, column name) and holding a set of (table name, column name)
+# - recorded by track_column_dependencies and used to clear exactly the
+# cached columns which depend on a column when it is written.  A column name
+# of _ALL_COLUMNS stands for every column of the table (e.g. when the whole
+# frame was read) and a table name of _ALL_COLUMNS for every table (when the
+# column looks tables up itself, where the reads can't be seen)
+_COLUMN_DEPENDENCIES = {}
+_ALL_COLUMNS = "*"
+
+# the orca functions which give a computed column tables it wasn't passed
+_TABLE_LOOKUPS = {"get_table", "get_raw_table", "get_raw_column",
+                  "merge_tables", "eval_variable"}
+
+
+class _ColumnRecorder(object):
+    """
+    Stands in for a table passed to a computed column and records which of
+    the table's columns are read - reading the whole frame counts as reading
+    every column, and reading the index as reading the table (which only
+    changes when the table is replaced).
+    """
+    def __init__(self, table, reads):
+        self._table = table
+        self._reads = reads
+
+    def _record(self, columns):
+        self._reads.update((self._table.name, c) for c in columns)
+
+    def __getattr__(self, key):
+        if key in self._table.columns or key == "index":
+            self._record([key])
+        elif key == "local":
+            self._record([_ALL_COLUMNS])
+        return getattr(self._table, key)
+
+    def __getitem__(self, key):
+        self._record([key])
+        return self._table[key]
+
+    def __len__(self):
+        return len(self._table)
+
+    def get_column(self, column_name):
+        self._record([column_name])
+        return self._table.get_column(column_name)
+
+    def to_frame(self, columns=None):
+        self._record(columns if columns is not None else [_ALL_COLUMNS])
+        return self._table.to_frame(columns)
+
+
+def _record_reads(tbl, columns):
+    """
+    Record columns that a computed column reads without going through the
+    table wrapper, e.g. straight from tbl.local.
+    """
+    if isinstance(tbl, _ColumnRecorder):
+        tbl._record(columns)
+
+
+def _unwrapped(tbl):
+    """
+    Get the table behind a recorder, so a helper can read tbl.local without
+    that counting as a read of every column - the helper records the
+    columns it actually uses with _record_reads.
+    """
+    return tbl._table if isinstance(tbl, _ColumnRecorder) else tbl
+
+
+def _looks_up_tables(code):
+    # whether a function (or a function defined in it) calls orca to get a
+    # table, which the recorder can't see the reads of
+    if _TABLE_LOOKUPS & set(code.co_names):
+        return True
+    return any(_looks_up_tables(c) for c in code.co_consts
+               if hasattr(c, "co_names"))
+
+
+def _recording(table_name, column_name, func):
+    code = getattr(func, "__code__", None)
+    untracked = code is None or _looks_up_tables(code)
+
+    @functools.wraps(func)
+    def wrapper(**kwargs):
+        reads = set([(_ALL_COLUMNS, _ALL_COLUMNS)]) if untracked else set()
+        kwargs = {
+            k: _ColumnRecorder(v, reads)
+            if isinstance(v, orca.DataFrameWrapper) else v
+            for k, v in kwargs.items()
+        }
+        result = func(**kwargs)
+        _COLUMN_DEPENDENCIES.setdefault(
+            (table_name, column_name), set()).update(reads)
+        return result
+    wrapper._recording = True
+    return wrapper
+
+
+def track_column_dependencies():
+    """
+    Record which columns each computed column registered with orca reads
+    when it is computed, so that writes through update_col_from_series and
+    add_table clear the cached values of exactly the columns which depend on
+    the written columns and nothing else.  Columns whose functions get
+    tables from orca themselves (rather than as arguments) are cleared by
+    any write, since what they read can't be recorded.  variables.py calls
+    this once its columns are defined - columns registered later are only
+    tracked if this is called again (it is safe to call more than once).
+
+    Returns
+    -------
+    Nothing
+    """
+    for (table_name, column_name), col in orca.orca._COLUMNS.items():
+        func = getattr(col, "_func", None)
+        if func is None or getattr(func, "_recording", False):
+            continue
+        # orca calls the function with keyword arguments collected from the
+        # argspec it took at registration, so it can be wrapped in place
+        col._func = _recording(table_name, column_name, func)
+
+
+def dependent_columns(table_name, columns=None):
+    """
+    Get the computed columns which read the given columns, directly or
+    through other computed columns, as far as they have been recorded by
+    track_column_dependencies.
+
+    Parameters
+    ----------
+    table_name : str
+        The table which was written
+    columns : list of str, optional
+        The columns which were written.  If not given the whole table was
+        replaced.
+
+    Returns
+    -------
+    A set of (table name, column name)
+    """
+    everything = set([(_ALL_COLUMNS, _ALL_COLUMNS),
+                      (table_name, _ALL_COLUMNS)])
+    if columns is None:
+        def reads_changed(reads):
+            return any(t in (table_name, _ALL_COLUMNS) for t, _ in reads) or \
+                len(reads & found)
+    else:
+        changed = set((table_name, c) for c in columns) | everything
+
+        def reads_changed(reads):
+            return len(reads & changed) or len(reads & found)
+
+    found = set()
+    while True:
+        new = [key for key, reads in _COLUMN_DEPENDENCIES.items()
+               if key not in found and reads_changed(reads)]
+        if not new:
+            return found
+        found.update(new)
+
+
+# the number of agents in each location, keyed by the agents table and the
+# location column - counted once and then kept up to date by the helpers in
+# this module which move agents around, instead of recounting every agent
+# each time a vacancy is needed
+_OCCUPANCY = {}
+
+
+def occupancy_counts(agents, fieldname):
+    """
+    Get the number of agents in each location, e.g. the number of
+    households in each building.  The counts are kept up to date as agents
+    are moved by the helpers in this module, and are recounted if the agents
+    table is replaced or the location column is written through
+    update_col_from_series or add_table.  Other writes to the location
+    column (e.g. straight into tbl.local) aren't seen, so anything which
+    moves agents has to go through those.
+
+    Parameters
+    ----------
+    agents : DataFrameWrapper
+        The table of agents
+    fieldname : str
+        The column in agents which holds the location ids (unplaced agents
+        are -1 and are not counted)
+
+    Returns
+    -------
+    A Series of counts indexed by location id
+    """
+    _record_reads(agents, [fieldname])
+    agents = _unwrapped(agents)
+    key = (agents.name, fieldname)
+    entry = _OCCUPANCY.get(key)
+    if entry is None or entry["frame"] is not agents.local:
+        counts = agents.local[fieldname].value_counts()
+        entry = {
+            "frame": agents.local,
+            "counts": counts[counts.index >= 0]
+        }
+        _OCCUPANCY[key] = entry
+    return entry["counts"]
+
+
+def _shift_counts(counts, old_locations, new_locations):
+    delta = pd.Series(new_locations).value_counts().sub(
+        pd.Series(old_locations).value_counts(), fill_value=0)
+    counts = counts.add(delta, fill_value=0).astype('int')
+    return counts[(counts.index >= 0) & (counts.values != 0)]
+
+
+# aggregates of building columns to parcels, keyed by the column and the
+# aggregation - when the developer helpers add or remove buildings only the
+# parcels they built on are recomputed, and otherwise the values are reused
+# for as long as the buildings table is the same
+_PARCEL_AGGREGATES = {}
+
+
+def parcel_aggregate(parcels, buildings, column, how="sum", fill_value=0):
+    """
+    Aggregate a building column to parcels, e.g. the total residential
+    units on each parcel.  The result is cached until the buildings table is
+    replaced or the column, parcel_id or a column they are computed from is
+    written through update_col_from_series (other writes, e.g. straight
+    into tbl.local, aren't seen), and when run_developer or
+    scheduled_development_events replace the buildings table only the
+    parcels which were built on are recomputed.
+
+    Parameters
+    ----------
+    parcels : DataFrameWrapper
+        The parcels table
+    buildings : DataFrameWrapper
+        The buildings table
+    column : str
+        The building column to aggregate
+    how : str, optional
+        The aggregation, e.g. "sum" or "min"
+    fill_value : optional
+        The value for parcels without buildings
+
+    Returns
+    -------
+    A Series indexed by parcel_id, which is the caller's to modify
+    """
+    _record_reads(buildings, [column, "parcel_id"])
+    buildings = _unwrapped(buildings)
+    key = (column, how, fill_value)
+    entry = _PARCEL_AGGREGATES.get(key)
+    if entry is not None and entry["frame"] is buildings.local and \
+            (entry["values"].index is parcels.index or
+             entry["values"].index.equals(parcels.index)):
+        return entry["values"].copy()
+
+    values = buildings[column].groupby(buildings.parcel_id).agg(how).\
+        reindex(parcels.index).fillna(fill_value)
+    _PARCEL_AGGREGATES[key] = {
+        "frame": buildings.local,
+        "column": column,
+        "how": how,
+        "fill_value": fill_value,
+        "values": values
+    }
+    return values.copy()
+
+
+def _buildings_replaced(old_frame, parcel_ids):
+    """
+    Update the cached parcel aggregates after the buildings table has been
+    replaced with one where only the buildings on the given parcels changed.
+    """
+    buildings = orca.get_table("buildings")
+    changed = np.unique(np.asarray(parcel_ids))
+    on_changed = sorted_isin(buildings.parcel_id.values, changed)
+    changed_parcel_ids = buildings.parcel_id[on_changed]
+
+    for entry in _PARCEL_AGGREGATES.values():
+        if entry["frame"] is not old_frame:
+            continue
+        values = buildings[entry["column"]][on_changed].\
+            groupby(changed_parcel_ids).agg(entry["how"])
+        result = entry["values"].copy()
+        changed_in_parcels = result.index.intersection(changed)
+        result.loc[changed_in_parcels] = values.reindex(changed_in_parcels).\
+            fillna(entry["fill_value"]).values
+        entry["values"] = result
+        entry["frame"] = buildings.local
+
+
+def _relocate_agents(agents, fieldname, new_locations, cast=False):
+    """
+    Write new locations for some of the agents, keeping the occupancy counts
+    for the location column up to date rather than dropping them.
+    """
+    key = (agents.name, fieldname)
+    entry = _OCCUPANCY.pop(key, None)
+    old_locations = agents.local[fieldname].loc[new_locations.index].values
+
+    update_col_from_series(agents, fieldname, new_locations, cast=cast)
+
+    if entry is not None and entry["frame"] is agents.local:
+        entry["counts"] = _shift_counts(
+            entry["counts"], old_locations, new_locations.values)
+        _OCCUPANCY[key] = entry
+
+
+def _replace_agents(agents, df, fieldname, removed):
+    """
+    Register a transitioned agents table, keeping the occupancy counts for
+    the location column up to date - agents which were added are unplaced so
+    only the agents which were removed change the counts.
+    """
+    key = (agents.name, fieldname)
+    entry = _OCCUPANCY.pop(key, None)
+    if entry is not None and entry["frame"] is agents.local:
+        old_locations = agents.local[fieldname].loc[removed].values
+        entry["counts"] = _shift_counts(entry["counts"], old_locations, [])
+    else:
+        entry = None
+
+    tbl = add_table(agents.name, df)
+
+    if entry is not None:
+        entry["frame"] = tbl.local
+        _OCCUPANCY[key] = entry
+
+
+def _count_nas(df):
+    """
+    Count the nas and infs in each column of df, a column at a time so the
+    frame is never copied - numpy integer and boolean columns can't hold
+    either so are skipped, numpy float columns are checked with np.isfinite
+    and any other columns (including the nullable extension types, which
+    can hold NA) are checked with isnull.
+    """
+    counts = pd.Series(0, index=df.columns)
+
+    for i, col in enumerate(df.columns):
+        s = df.iloc[:, i]
+        dtype = s.dtype
+        if isinstance(dtype, np.dtype) and dtype.kind in "iub":
+            continue
+        elif isinstance(dtype, np.dtype) and dtype.kind in "fc":
+            counts.iloc[i] = len(s) - np.isfinite(s.values).sum()
+        else:
+            counts.iloc[i] = s.isnull().sum()
+            if pd.api.types.is_float_dtype(dtype):
+                counts.iloc[i] += (s.abs() == np.inf).sum()
+
+    return counts
+
+
+@profiled
+def check_nas(df, level=None):
     """
     Checks for nas and errors if they are found (also prints a report on how
     many nas are found in each column)
@@ -70,21 +900,42 @@ def check_nas(df):
     ----------
     df : DataFrame
         DataFrame to check for nas
+    level : str, optional
+        One of "full" (check every row), "sampled" (check a random sample
+        of rows, the size of which is given by the "validation_sample_size"
+        setting and defaults to 100,000) or "off" (don't check at all).  If
+        not given the "validation_level" setting is used, which defaults to
+        "full".
 
     Returns
     -------
     Nothing
     """
+    level = level or _get_setting("validation_level", "full")
+    assert level in ("full", "sampled", "off"), \
+        "Validation level not found!"
+
+    if level == "off":
+        return
+
+    if level == "sampled":
+        sample_size = _get_setting("validation_sample_size", 100000)
+        if len(df) > sample_size:
+            # a private random state, so that the validation level never
+            # changes the draws of the models
+            rs = random_state("check_nas") or np.random.RandomState()
+            rows = np.sort(rs.choice(len(df), sample_size, replace=False))
+            df = df.iloc[rows]
+
     df_cnt = len(df)
     fail = False
 
-    df = df.replace([np.inf, -np.inf], np.nan)
+    counts = _count_nas(df)
     for col in df.columns:
-        s_cnt = df[col].count()
-        if df_cnt != s_cnt:
+        if counts[col] > 0:
             fail = True
             print("Found %d nas or inf (out of %d) in column %s" % \
-                  (df_cnt-s_cnt, df_cnt, col))
+                  (counts[col], df_cnt, col))
 
     assert not fail, "NAs were found in dataframe, please fix"
 
@@ -165,6 +1016,271 @@ def table_reprocess(cfg, df):
     return df
 
 
+# parsed model configurations shared by all the helpers in this module -
+# keyed by the absolute path of the yaml file and holding the file's
+# modification time and size so an edited (or re-estimated) file is parsed
+# again the next time it is used
+_MODEL_CACHE = {}
+
+
+def _cfg_stamp(cfg):
+    st = os.stat(cfg)
+    return st.st_mtime, st.st_size
+
+
+def _cached_model(cfg):
+    key = os.path.abspath(cfg)
+    stamp = _cfg_stamp(cfg)
+    entry = _MODEL_CACHE.get(key)
+    if entry is not None and entry["stamp"] == stamp:
+        return entry
+
+    import yaml
+
+    with open(cfg) as f:
+        yaml_str = f.read()
+    model_type = yaml.safe_load(yaml_str).get("model_type")
+
+    model_class = {
+        "regression": RegressionModel,
+        "segmented_regression": SegmentedRegressionModel,
+        "discretechoice": MNLDiscreteChoiceModel,
+        "segmented_discretechoice": SegmentedMNLDiscreteChoiceModel
+    }[model_type]
+    model = model_class.from_yaml(yaml_str=yaml_str)
+
+    entry = {
+        "stamp": stamp,
+        "class": model_class,
+        "model": model,
+        "columns_used": model.columns_used()
+    }
+    _MODEL_CACHE[key] = entry
+    return entry
+
+
+def load_model(cfg):
+    """
+    Get the model object for a YAML configuration file.  The file is only
+    parsed the first time it is used (or when it has changed on disk) and
+    the same object is returned to every caller, so it should be treated as
+    read-only - use the class's from_yaml to get a private copy.
+
+    Parameters
+    ----------
+    cfg : str
+        The path to the YAML configuration file.
+
+    Returns
+    -------
+    The model object (RegressionModel, SegmentedRegressionModel,
+    MNLDiscreteChoiceModel, or SegmentedMNLDiscreteChoiceModel)
+    """
+    return _cached_model(cfg)["model"]
+
+
+def model_columns_used(cfg):
+    """
+    Get the columns used by the model in a YAML configuration file, using
+    the same cache as load_model.
+
+    Parameters
+    ----------
+    cfg : str
+        The path to the YAML configuration file.
+
+    Returns
+    -------
+    A list of column names
+    """
+    return list(_cached_model(cfg)["columns_used"])
+
+
+def clear_model_cache(cfg=None):
+    """
+    Remove parsed model configurations from the cache.
+
+    Parameters
+    ----------
+    cfg : str, optional
+        The path to the YAML configuration file to forget.  If not given the
+        whole cache is cleared.
+
+    Returns
+    -------
+    Nothing
+    """
+    if cfg is None:
+        _MODEL_CACHE.clear()
+    else:
+        _MODEL_CACHE.pop(os.path.abspath(cfg), None)
+
+
+@profiled
+def compact_dtypes(cfg, df, table_name="table"):
+    """
+    Reduce the memory used by a table by downcasting its numeric columns to
+    the smallest type that holds their values, and converting code columns
+    to categoricals.  The columns are replaced in df itself, so the table
+    is never held twice.
+
+    Parameters
+    ----------
+    cfg : dict
+        The configuration is specified as a nested dictionary, javascript
+        style, and all keys are optional.  "min_int" is the smallest integer
+        type to downcast to (int32 by default - smaller types only suit
+        columns whose values can't grow past the base year's much, so
+        columns which are incremented, like unit counts, should be
+        excluded when using them), "float" is the type to convert float
+        columns to (they are left alone if it is not given), "categorical"
+        is a list of columns to convert to categoricals, "max_categories"
+        converts any string column with at most that many distinct values
+        to a categorical, and "exclude" is a list of columns to leave alone.
+        Id columns (those that end with "_id") are always left as they are,
+        as are columns which the models write to without casting (e.g. the
+        prices written by the hedonics), so those should be excluded.::
+
+            {
+                "min_int": "int16",
+                "float": "float32",
+                "categorical": ["tenure"],
+                "max_categories": 50,
+                "exclude": ["residential_price", "non_residential_price",
+                            "residential_units"]
+            }
+
+    df : DataFrame to compact
+
+    table_name : str, optional
+        The name of the table, for the report of the memory saved
+
+    Returns
+    -------
+    The same DataFrame, with compacted columns
+    """
+    int_types = ["int8", "int16", "int32", "int64"]
+    min_int = cfg.get("min_int", "int32")
+    int_types = int_types[int_types.index(min_int):]
+    exclude = set(cfg.get("exclude", []))
+    categorical = set(cfg.get("categorical", []))
+    max_categories = cfg.get("max_categories", None)
+
+    # only the converted columns are measured, before and after
+    saved = 0
+    converted = 0
+    for col in list(df.columns):
+        if col in exclude or col.endswith("_id"):
+            continue
+        s = df[col]
+        kind = s.dtype.kind
+        new = None
+
+        if col in categorical or (kind == "O" and max_categories and
+                                  s.nunique() <= max_categories):
+            new = s.astype("category")
+        elif kind in "iu" and len(s):
+            lo, hi = s.min(), s.max()
+            for typ in int_types:
+                info = np.iinfo(typ)
+                if info.min <= lo and hi <= info.max:
+                    if typ != str(s.dtype):
+                        new = s.astype(typ)
+                    break
+        elif kind == "f" and "float" in cfg and \
+                str(s.dtype) != cfg["float"]:
+            new = s.astype(cfg["float"])
+
+        if new is not None:
+            saved += s.memory_usage(deep=True, index=False) - \
+                new.memory_usage(deep=True, index=False)
+            converted += 1
+            df[col] = new
+
+    print("Compacted {:,} columns of {} (saved {:,.1f} MB)".format(
+        converted, table_name, saved / 1e6))
+    return df
+
+
+# merged frames built by to_frame, keyed by the table the others were merged
+# onto and the set of merged tables - entries only live for one iteration of
+# the simulation and are dropped as soon as a column they hold is written
+# through update_col_from_series or add_table
+_FRAME_CACHE = {}
+
+
+def invalidate_frame_cache(table_name=None, columns=None):
+    """
+    Drop cached merged frames which were built from the given table.
+
+    Parameters
+    ----------
+    table_name : str, optional
+        The name of the table which has changed.  If not given all cached
+        frames are dropped.
+    columns : list of str, optional
+        The columns of the table which have changed (including the computed
+        columns which depend on them).  If given only the frames holding one
+        of these columns, or a computed column whose dependencies have not
+        been recorded, are dropped.  If not given all frames built from the
+        table are dropped.
+
+    Returns
+    -------
+    Nothing
+    """
+    if table_name is None:
+        _FRAME_CACHE.clear()
+        return
+    for key in [k for k in _FRAME_CACHE if table_name in k[1]]:
+        if columns is None or \
+                _frame_depends_on(key[1], _FRAME_CACHE[key]["frame"], columns):
+            del _FRAME_CACHE[key]
+
+
+def _frame_depends_on(table_names, frame, columns):
+    if len(set(columns) & set(frame.columns)):
+        return True
+    # computed columns we don't know the dependencies of might read anything
+    for t in table_names:
+        for c in orca.list_columns_for_table(t):
+            if c in frame.columns and (t, c) not in _COLUMN_DEPENDENCIES:
+                return True
+    return False
+
+
+def _merge_tables_cached(tables, columns):
+    """
+    Merge the tables onto the first one like orca.merge_tables, but reuse
+    columns that were already merged for the same set of tables in this
+    iteration and only merge the columns that are missing.
+    """
+    iter_var = _iter_var()
+    key = (tables[0].name, frozenset(t.name for t in tables))
+    entry = _FRAME_CACHE.get(key)
+    if entry is not None and entry["iter_var"] != iter_var:
+        _FRAME_CACHE.clear()
+        entry = None
+
+    if entry is None:
+        df = orca.merge_tables(target=tables[0].name,
+                               tables=tables, columns=columns)
+        _FRAME_CACHE[key] = {"iter_var": iter_var, "frame": df}
+        return df[columns]
+
+    cached = entry["frame"]
+    missing = [c for c in columns if c not in cached.columns]
+    if len(missing):
+        new = orca.merge_tables(target=tables[0].name,
+                                tables=tables, columns=missing)
+        new = new[[c for c in new.columns if c not in cached.columns]]
+        cached = pd.concat([cached, new.reindex(cached.index)], axis=1)
+        entry["frame"] = cached
+
+    return cached[columns]
+
+
+@profiled
 def to_frame(tbl, join_tbls, cfg, additional_columns=[]):
     """
     Leverage all the built in functionality of the sim framework to join to
@@ -189,13 +1305,28 @@ def to_frame(tbl, join_tbls, cfg, additional_columns=[]):
     -------
     A single DataFrame with the index from tbl and the columns used by cfg
     and any additional columns specified
+
+    If the "frame_cache" setting is True, the columns used by cfg are
+    merged through a cache which lives for one iteration, so that several
+    models which join the same tables in a year share the merges.  Cached
+    columns are assumed to depend only on the merged tables - the additional
+    columns (usually supply and vacancy columns which depend on agents) are
+    always merged fresh.
     """
     join_tbls = join_tbls if isinstance(join_tbls, list) else [join_tbls]
     tables = [tbl] + join_tbls
-    cfg = yaml_to_class(cfg).from_yaml(str_or_buffer=cfg)
     tables = [t for t in tables if t is not None]
-    columns = misc.column_list(tables, cfg.columns_used()) + additional_columns
-    if len(tables) > 1:
+    columns = misc.column_list(tables, model_columns_used(cfg)) + \
+        additional_columns
+    if len(tables) > 1 and _get_setting("frame_cache", False):
+        df = _merge_tables_cached(
+            tables, [c for c in columns if c not in additional_columns])
+        if len(additional_columns):
+            extra = orca.merge_tables(target=tables[0].name, tables=tables,
+                                      columns=additional_columns)
+            df = pd.concat([df, extra[additional_columns].reindex(df.index)],
+                           axis=1)
+    elif len(tables) > 1:
         df = orca.merge_tables(target=tables[0].name,
                                tables=tables, columns=columns)
     else:
@@ -221,21 +1352,135 @@ def yaml_to_class(cfg):
         YAML file. This can be one of: RegressionModel, SegmentedRegressionModel,
         MNLDiscreteChoiceModel, or SegmentedMNLDiscreteChoiceModel.
     """
+    return _cached_model(cfg)["class"]
+
+
+# the keys of a model's yaml which hold the results of fitting it rather
+# than its specification
+_FIT_RESULT_KEYS = {"fitted", "fit_parameters", "fit_rsquared",
+                    "fit_rsquared_adj", "log_likelihoods"}
+
+
+def _model_spec(cfg):
+    """
+    The specification of the model in a yaml file, without any results of
+    fitting it, as a string which is the same for the same specification.
+    """
     import yaml
 
-    # Context manager ensures 'cfg' is closed after use
+    def strip(d):
+        if isinstance(d, dict):
+            return {k: strip(v) for k, v in d.items()
+                    if k not in _FIT_RESULT_KEYS}
+        return d
+
     with open(cfg) as f:
-        yaml_data = yaml.safe_load(f)
-        model_type = yaml_data.get("model_type")
+        spec = strip(yaml.safe_load(f))
+    return json.dumps(spec, sort_keys=True, default=str)
 
-    return {
-        "regression": RegressionModel,
-        "segmented_regression": SegmentedRegressionModel,
-        "discretechoice": MNLDiscreteChoiceModel,
-        "segmented_discretechoice": SegmentedMNLDiscreteChoiceModel
-    }[model_type]
+
+def _estimation_keys(frames, extra=None):
+    """
+    Hash the estimation frames (their columns, dtypes, index and values),
+    to be combined with a model spec.
+
+    Returns
+    -------
+    A function of a config file which returns the key for the spec in
+    that file and the frames
+    """
+    h = hashlib.sha1(json.dumps(extra, default=str).encode())
+    for df in frames:
+        h.update(json.dumps([[str(c) for c in df.columns],
+                             [str(t) for t in df.dtypes]]).encode())
+        h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    data = h.hexdigest()
+
+    def key(cfg):
+        return hashlib.sha1(
+            (data + _model_spec(cfg)).encode()).hexdigest()
+    return key
+
+
+def _estimation_cache_file(key):
+    d = os.path.join(misc.data_dir(), "estimation_cache")
+    if not os.path.exists(d):
+        os.makedirs(d)
+    return os.path.join(d, key + ".yaml")
+
+
+def _write_atomically(path, text):
+    # write next to the file and move it into place, so that a run which is
+    # interrupted (or one running alongside) never sees half a file
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _report_fit(model):
+    """
+    Print the fit of a model loaded from a fitted config, like urbansim does
+    after fitting it (the coefficient tables rather than the statsmodels
+    summary, which isn't stored in the config).
+    """
+    if isinstance(model, (SegmentedRegressionModel,
+                          SegmentedMNLDiscreteChoiceModel)):
+        label = "REGRESSION" if isinstance(
+            model, SegmentedRegressionModel) else "LCM"
+        for name, segment in model._group.models.items():
+            print("%s RESULTS FOR SEGMENT %s\n" % (label, str(name)))
+            segment.report_fit()
+    else:
+        model.report_fit()
 
 
+def _memoized_fit(cfg, out_cfg, frames, fit, extra=None):
+    """
+    Fit a model through the estimation cache when the "estimation_cache"
+    setting is True.  When the spec in cfg was already fit to the same
+    frames, the fitted config is written to out_cfg (if it isn't there
+    already) and the model is loaded from it and its fit printed instead of
+    being fit again.  Otherwise fit() is called, which should write the fitted config to
+    out_cfg, and the result is stored under both the spec it was fit from
+    and the spec it was written as (which can differ, e.g. a segmented
+    model lists its segments once it's fit), so that refitting the output
+    config hits the cache as well.
+    """
+    if not _get_setting("estimation_cache", False):
+        return fit()
+
+    key = _estimation_keys(frames, extra)
+    cached = _estimation_cache_file(key(cfg))
+    if os.path.exists(cached):
+        with open(cached) as f:
+            yaml_str = f.read()
+        print("Using the cached fit of %s" % os.path.basename(cfg))
+        current = None
+        if os.path.exists(out_cfg):
+            with open(out_cfg) as f:
+                current = f.read()
+        if current != yaml_str:
+            _write_atomically(out_cfg, yaml_str)
+        clear_model_cache(out_cfg)
+        model = yaml_to_class(out_cfg).from_yaml(yaml_str=yaml_str)
+        _report_fit(model)
+        return model
+
+    spec_key = key(cfg)
+    model = fit()
+    with open(out_cfg) as f:
+        yaml_str = f.read()
+    for k in {spec_key, key(out_cfg)}:
+        _write_atomically(_estimation_cache_file(k), yaml_str)
+    return model
+
+
+@profiled
 def hedonic_estimate(cfg, tbl, join_tbls, out_cfg=None):
     """
     Estimate the hedonic model for the specified table
@@ -252,80 +1497,688 @@ def hedonic_estimate(cfg, tbl, join_tbls, out_cfg=None):
     out_cfg : string, optional
         The name of the yaml config file to which to write the estimation results.
         If not given, the input file cfg is overwritten.
+
+    If the "estimation_cache" setting is True and the same spec has already
+    been fit to the same data, the stored fit is used instead of fitting
+    the model again.
     """
     cfg = misc.config(cfg)
     df = to_frame(tbl, join_tbls, cfg)
     if out_cfg is not None:
         out_cfg = misc.config(out_cfg)
-    return yaml_to_class(cfg).fit_from_cfg(df, cfg, outcfgname=out_cfg)
+
+    def fit():
+        hm = yaml_to_class(cfg).fit_from_cfg(df, cfg, outcfgname=out_cfg)
+        clear_model_cache(out_cfg or cfg)
+        return hm
+
+    return _memoized_fit(cfg, out_cfg or cfg, [df], fit)
+
+
+@profiled
+def hedonic_simulate(cfg, tbl, join_tbls, out_fname, cast=False,
+                     workers=None, chunksize=None, incremental=False):
+    """
+    Simulate the hedonic model for the specified table
+
+    Parameters
+    ----------
+    cfg : string
+        The name of the yaml config file from which to read the hedonic model
+    tbl : DataFrameWrapper
+        A dataframe for which to estimate the hedonic
+    join_tbls : list of strings
+        A list of land use dataframes to give neighborhood info around the
+        buildings - will be joined to the buildings using existing broadcasts
+    out_fname : string
+        The output field name (should be present in tbl) to which to write
+        the resulting column to
+    cast : boolean
+        Should the output be cast to match the existing column.
+    workers : int, optional
+        If given, the segments of a segmented model (and the chunks, if
+        chunksize is given) are predicted on this many worker processes at
+        once, which share the data with this process rather than getting a
+        copy of it.  The result is the same as predicting them one after
+        the other.
+    chunksize : int, optional
+        If given, the rows are predicted in blocks of at most this many
+        rows, which bounds the size of the design matrix built for the
+        prediction.  Each block is predicted with the design (categories
+        and transform state) of all the rows, so the result is the same as
+        predicting all the rows at once.  The merged frame from to_frame
+        is still built whole, so this bounds the memory of the prediction
+        and not that of the step.
+    incremental : boolean, optional
+        If True, only the rows whose values in the columns used by the model
+        changed since the last incremental run for this config, table and
+        output column are predicted, and the rest keep their last predicted
+        values (rather than the current values of out_fname, which other
+        models may have adjusted).  The changed rows are predicted with the
+        design of all the rows, so the result is the same as predicting
+        them all - and everything is predicted again when the design
+        itself changes or uses a stateful transform such as center().
+    """
+    cfg = misc.config(cfg)
+    df = to_frame(tbl, join_tbls, cfg)
+    hm = load_model(cfg)
+    if incremental:
+        price_or_rent = _incremental_hedonic_predict(
+            cfg, (cfg, tbl.name, out_fname), df, chunksize, workers)
+    elif chunksize or (workers and isinstance(hm, SegmentedRegressionModel)):
+        price_or_rent = _hedonic_predict(hm, df, chunksize, workers)
+    else:
+        price_or_rent = hm.predict(df)
+    print(price_or_rent.describe())
+    update_col_from_series(tbl, out_fname, price_or_rent, cast=cast)
+
+
+@profiled
+@seeded
+def lcm_estimate(cfg, choosers, chosen_fname, buildings, join_tbls, out_cfg=None):
+    """
+    Estimate the location choices for the specified choosers
+
+    Parameters
+    ----------
+    cfg : string
+        The name of the yaml config file from which to read the location
+        choice model
+    choosers : DataFrameWrapper
+        A dataframe of agents doing the choosing
+    chosen_fname : str
+        The name of the column (present in choosers) which contains the ids
+        that identify the chosen alternatives
+    buildings : DataFrameWrapper
+        A dataframe of buildings which the choosers are locating in and which
+        have a supply.
+    join_tbls : list of strings
+        A list of land use dataframes to give neighborhood info around the
+        buildings - will be joined to the buildings using existing broadcasts
+    out_cfg : string, optional
+        The name of the yaml config file to which to write the estimation results.
+        If not given, the input file cfg is overwritten.
+
+    If the "estimation_cache" setting is True and the same spec has already
+    been fit to the same choosers and alternatives, the stored fit is used
+    instead of fitting the model again.
+    """
+    cfg = misc.config(cfg)
+    choosers = to_frame(choosers, [], cfg, additional_columns=[chosen_fname])
+    alternatives = to_frame(buildings, join_tbls, cfg)
+    if out_cfg is not None:
+        out_cfg = misc.config(out_cfg)
+
+    def fit():
+        lcm = yaml_to_class(cfg).fit_from_cfg(choosers,
+                                              chosen_fname,
+                                              alternatives,
+                                              cfg,
+                                              outcfgname=out_cfg)
+        clear_model_cache(out_cfg or cfg)
+        return lcm
+
+    return _memoized_fit(cfg, out_cfg or cfg, [choosers, alternatives], fit,
+                         extra=chosen_fname)
+
+
+def _capacity_choice(chooser_ids, alternative_ids, probabilities, capacity):
+    """
+    Have a set of choosers choose from among alternatives which can each
+    absorb several choosers.  This is the same as urbansim's unit_choice
+    when every alternative is expanded to one row per unit of capacity, but
+    without ever building the expanded arrays.
+
+    Parameters
+    ----------
+    chooser_ids : 1d array_like
+        Array of IDs of the agents that are making choices.
+    alternative_ids : 1d array_like
+        Array of IDs of alternatives among which agents are making choices.
+    probabilities : 1d array_like
+        The probability that an agent will choose a single unit of an
+        alternative.  Must be the same shape as `alternative_ids`.
+    capacity : 1d array_like
+        The number of choosers each alternative can absorb.  Must be the
+        same shape as `alternative_ids`.
+
+    Returns
+    -------
+    choices : pandas.Series
+        Mapping of chooser ID to alternative ID. Some choosers
+        will map to a nan value when there is not enough capacity
+        for all the choosers.
+    """
+    chooser_ids = np.asanyarray(chooser_ids)
+    alternative_ids = np.asanyarray(alternative_ids)
+    probabilities = np.asanyarray(probabilities, dtype='float64')
+    capacity = np.asanyarray(capacity).astype('int64').copy()
+
+    chosen = np.full(len(chooser_ids), np.nan)
+    unplaced = np.arange(len(chooser_ids))
+
+    while len(unplaced) > 0:
+        # each remaining unit of an alternative is equally likely, so the
+        # alternative is weighted by how much capacity it has left
+        weights = probabilities * capacity.clip(min=0)
+        total = weights.sum()
+        if total <= 0:
+            break
+
+        drawn = np.random.choice(len(alternative_ids), size=len(unplaced),
+                                 p=weights / total)
+
+        # when more choosers pick an alternative than it has room for, a
+        # random subset of them gets in and the rest choose again
+        order = np.random.permutation(len(unplaced))
+        unplaced, drawn = unplaced[order], drawn[order]
+        sort = np.argsort(drawn, kind='mergesort')
+        sorted_drawn = drawn[sort]
+        starts = np.r_[0, np.flatnonzero(np.diff(sorted_drawn)) + 1]
+        sizes = np.diff(np.r_[starts, len(sorted_drawn)])
+        rank = np.arange(len(sorted_drawn)) - np.repeat(starts, sizes)
+        accepted = np.empty(len(drawn), dtype='bool')
+        accepted[sort] = rank < capacity[sorted_drawn]
+
+        chosen[unplaced[accepted]] = alternative_ids[drawn[accepted]]
+        capacity -= np.bincount(drawn[accepted], minlength=len(capacity))
+        unplaced = unplaced[~accepted]
+
+    return pd.Series(chosen, index=chooser_ids)
+
+
+def _aggregate_choices(lcm):
+    """
+    Whether a location choice model makes its choices in aggregate, the
+    only mode in which the choices can be made from buildings weighted by
+    their vacant units - in individual mode each chooser has its own
+    probabilities and takes a single unit.
+    """
+    return lcm.choice_mode == 'aggregate' and \
+        lcm.probability_mode == 'single_chooser'
+
+
+def _capacity_weighted_predict(lcm, choosers, alternatives, capacity,
+                               workers=None):
+    """
+    Predict location choices where the alternatives are buildings and the
+    number of vacant units in each building is used as a sampling weight and
+    a capacity limit, instead of expanding the buildings to one row per
+    vacant unit.  This is only the same as predicting from the units for
+    models which make their choices in aggregate (see _aggregate_choices).
+
+    Parameters
+    ----------
+    lcm : MNLDiscreteChoiceModel or SegmentedMNLDiscreteChoiceModel
+        The fitted location choice model
+    choosers : DataFrame
+        A dataframe of agents doing the choosing
+    alternatives : DataFrame
+        A dataframe of buildings with at least one vacant unit
+    capacity : Series
+        The number of vacant units, indexed like alternatives
+    workers : int, optional
+        The number of worker processes to compute the probabilities of the
+        segments of a segmented model on
+
+    Returns
+    -------
+    choices : pandas.Series
+        Mapping of chooser ID to alternative ID. Some choosers will map to
+        a nan value when there are not enough units for all the choosers.
+    """
+    assert _aggregate_choices(lcm), \
+        "capacity weighted choices need an aggregate choice_mode and a " \
+        "single_chooser probability_mode"
+    choosers, alternatives = lcm.apply_predict_filters(choosers, alternatives)
+    choices = pd.Series(np.nan, index=choosers.index)
+
+    if len(choosers) == 0 or len(alternatives) == 0:
+        return choices
+
+    remaining = capacity.reindex(alternatives.index).fillna(0).astype('int')
+
+    if isinstance(lcm, SegmentedMNLDiscreteChoiceModel):
+        groups = choosers.groupby(lcm.segmentation_col)
+        if workers:
+            probs = [(name, p) for name, _, p in _segment_probabilities(
+                lcm, choosers, alternatives, workers) if p is not None]
+        else:
+            probs = lcm.probabilities(choosers, alternatives).items()
+        segments = [(groups.get_group(name).index, p) for name, p in probs]
+    else:
+        segments = [(choosers.index, lcm.probabilities(
+            choosers, alternatives, filter_tables=False))]
+
+    for chooser_ids, probs in segments:
+        # summing over choosers gives the aggregate demand for each building
+        probs = probs.groupby(level='alternative_id').sum().\
+            reindex(remaining.index).fillna(0)
+        placed = _capacity_choice(chooser_ids, remaining.index.values,
+                                  probs.values, remaining.values).dropna()
+        choices.loc[placed.index] = placed.values
+        remaining -= placed.value_counts().\
+            reindex(remaining.index).fillna(0).astype('int')
+
+    print("Assigned %d choosers to new units" % len(choices.dropna()))
+    return choices
 
 
-def hedonic_simulate(cfg, tbl, join_tbls, out_fname, cast=False):
+def _lcm_predict(lcm, choosers, alternatives, alternative_ratio=2.0,
+                 workers=None):
     """
-    Simulate the hedonic model for the specified table
+    The equivalent of predict_from_cfg for a model which has already been
+    loaded - alternatives are sampled down to alternative_ratio times the
+    number of choosers before predicting.  The segments of a segmented
+    model are predicted on that many worker processes if workers is given.
+    """
+    if len(alternatives) > len(choosers) * alternative_ratio:
+        idxes = np.random.choice(
+            alternatives.index,
+            size=int(np.floor(len(choosers) * alternative_ratio)),
+            replace=False)
+        alternatives = alternatives.loc[idxes]
+
+    if workers and isinstance(lcm, SegmentedMNLDiscreteChoiceModel):
+        new_units = _parallel_lcm_predict(lcm, choosers, alternatives, workers)
+    else:
+        new_units = lcm.predict(choosers, alternatives)
+    print("Assigned %d choosers to new units" % len(new_units.dropna()))
+    return new_units
 
-    Parameters
-    ----------
-    cfg : string
-        The name of the yaml config file from which to read the hedonic model
-    tbl : DataFrameWrapper
-        A dataframe for which to estimate the hedonic
-    join_tbls : list of strings
-        A list of land use dataframes to give neighborhood info around the
-        buildings - will be joined to the buildings using existing broadcasts
-    out_fname : string
-        The output field name (should be present in tbl) to which to write
-        the resulting column to
-    cast : boolean
-        Should the output be cast to match the existing column.
+
+# the model and frames the segment workers read from - filled in before the
+# worker processes are forked so that they share the parent's memory rather
+# than having the frames pickled to them, and emptied once they're done
+_SEGMENT_INPUTS = {}
+
+
+def _run_segments(func, tasks, inputs, workers):
     """
-    cfg = misc.config(cfg)
-    df = to_frame(tbl, join_tbls, cfg)
-    price_or_rent, _ = yaml_to_class(cfg).predict_from_cfg(df, cfg)
-    tbl.update_col_from_series(out_fname, price_or_rent, cast=cast)
+    Run func over the tasks on a pool of forked processes which share the
+    inputs, returning the results in the order of the tasks.  Runs in this
+    process when there's only one task or fork isn't available.
+    """
+    _SEGMENT_INPUTS.update(inputs)
+    try:
+        workers = min(int(workers), len(tasks))
+        if workers < 2 or not hasattr(multiprocessing, "get_context") or \
+                "fork" not in multiprocessing.get_all_start_methods():
+            return [func(task) for task in tasks]
+        pool = multiprocessing.get_context("fork").Pool(workers)
+        try:
+            # map returns the results in the order of the tasks however the
+            # workers finish, which keeps the merge deterministic
+            return pool.map(func, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _SEGMENT_INPUTS.clear()
+
+
+def _regression_segment(task):
+    name, positions = task
+    inputs = _SEGMENT_INPUTS
+    model = inputs["models"][name]
+    df = inputs["data"].iloc[positions]
+    design = inputs["designs"][name]
+    if design is None:
+        return model.predict(df)
+
+    # the same as the model's predict, but with the design matrix built
+    # from the design of all the rows of the segment rather than just these
+    values = patsy.build_design_matrices(
+        [design], df, return_type='dataframe')[0].\
+        dot(model.model_fit.params).values
+    if len(values) != len(df):
+        raise ModelEvaluationError(
+            'Predicted data does not have the same length as input. '
+            'This suggests there are null values in one or more of '
+            'the input columns.')
+    if model.ytransform:
+        values = model.ytransform(values)
+    return pd.Series(values, index=df.index)
+
+
+def _blocks(positions, chunksize):
+    step = chunksize or max(len(positions), 1)
+    return [positions[i:i + step]
+            for i in range(0, max(len(positions), 1), step)]
+
+
+def _segment_design(model, df, blocks):
+    """
+    The patsy design of a model loaded from yaml for the rows of df at the
+    blocks of positions, built a block at a time - the categories of the
+    categorical terms and the state of the stateful transforms are the
+    same as those of the design matrix of all the rows at once.  None for
+    a model which was fit in this process, whose predict already uses the
+    design it was fit with.
+    """
+    rhs = getattr(model.model_fit, "_rhs", None)
+    if rhs is None:
+        return None
+    return patsy.incr_dbuilder(
+        rhs, lambda: (df.iloc[b] for b in blocks),
+        eval_env=patsy.EvalEnvironment.capture())
 
 
-def lcm_estimate(cfg, choosers, chosen_fname, buildings, join_tbls, out_cfg=None):
+def _design_signatures(designs):
     """
-    Estimate the location choices for the specified choosers
+    What the predictions of the rows which didn't change depend on in the
+    design of each segment - its columns and the categories of its
+    categorical terms.  None when a design has stateful transforms (like
+    center), whose state depends on the values of every row.
+    """
+    signatures = {}
+    for name, design in designs.items():
+        if design is None:
+            signatures[name] = ()
+            continue
+        if any(info.state.get("transforms")
+               for info in design.factor_infos.values()):
+            return None
+        signatures[name] = (
+            tuple(design.column_names),
+            tuple(sorted((factor.name(), info.categories)
+                         for factor, info in design.factor_infos.items()
+                         if info.type == "categorical")))
+    return signatures
+
+
+def _filtered_positions(df, positions, filters):
+    if not filters:
+        return positions
+    rows = df.iloc[positions]
+    kept = util.apply_filter_query(rows, filters).index
+    return positions[rows.index.isin(kept)]
+
+
+def _hedonic_predict(hm, df, chunksize=None, workers=None, rows=None,
+                     signatures=None, designs=None):
+    """
+    The equivalent of hm.predict(df), with the rows predicted in blocks of
+    at most chunksize rows (within each segment of a segmented model) and
+    with the blocks predicted on a pool of worker processes if workers is
+    given.
+
+    The design of each segment (the categories of its categorical terms
+    and the state of its stateful transforms) is built from all of the
+    segment's rows, a block at a time, and every block is predicted with
+    it.  So the result is the same as predicting in one shot, whichever
+    levels a block happens to have, while the design matrix is never
+    built for more than chunksize rows.  The frame itself (which to_frame
+    builds whole) and the predictions are still the size of the table.
 
     Parameters
     ----------
-    cfg : string
-        The name of the yaml config file from which to read the location
-        choice model
-    choosers : DataFrameWrapper
-        A dataframe of agents doing the choosing
-    chosen_fname : str
-        The name of the column (present in choosers) which contains the ids
-        that identify the chosen alternatives
-    buildings : DataFrameWrapper
-        A dataframe of buildings which the choosers are locating in and which
-        have a supply.
-    join_tbls : list of strings
-        A list of land use dataframes to give neighborhood info around the
-        buildings - will be joined to the buildings using existing broadcasts
-    out_cfg : string, optional
-        The name of the yaml config file to which to write the estimation results.
-        If not given, the input file cfg is overwritten.
+    rows : array of bool, optional
+        Only predict these rows of df - the designs still come from all of
+        them, so the predictions are the same as those of all the rows
+    signatures : dict, optional
+        Predict all the rows after all, unless the signatures of the
+        designs (see _design_signatures) are these
+    designs : dict, optional
+        Filled in with the design of each segment, keyed by its name (None
+        for a model which isn't segmented)
     """
-    cfg = misc.config(cfg)
-    choosers = to_frame(choosers, [], cfg, additional_columns=[chosen_fname])
-    alternatives = to_frame(buildings, join_tbls, cfg)
-    if out_cfg is not None:
-        out_cfg = misc.config(out_cfg)
-    return yaml_to_class(cfg).fit_from_cfg(choosers,
-                                           chosen_fname,
-                                           alternatives,
-                                           cfg,
-                                           outcfgname=out_cfg)
+    selected = None
+    if rows is not None:
+        selected = df.index[rows]
+
+    # filtering first means a block is only empty when all the rows are
+    # filtered out (the model filters each block again, which keeps them)
+    df = util.apply_filter_query(df, hm.predict_filters)
+    if isinstance(hm, SegmentedRegressionModel):
+        positions = df.groupby(hm.segmentation_col).indices
+        models = hm._group.models
+        missing = [name for name in models if name not in positions]
+        assert not missing, "No rows for segments %s" % missing
+        segments = [(name, positions[name]) for name in models]
+    else:
+        models = {None: hm}
+        segments = [(None, np.arange(len(df)))]
+
+    segments = [(name, _filtered_positions(
+        df, positions, models[name].predict_filters))
+        for name, positions in segments]
+    segment_designs = {name: _segment_design(
+        models[name], df, _blocks(positions, chunksize))
+        for name, positions in segments}
+    if designs is not None:
+        designs.update(segment_designs)
+
+    if selected is not None and (
+            signatures is None or
+            _design_signatures(segment_designs) != signatures):
+        selected = None
+
+    tasks = []
+    for name, positions in segments:
+        if selected is not None:
+            positions = positions[df.index[positions].isin(selected)]
+            if len(positions) == 0:
+                continue
+        tasks += [(name, b) for b in _blocks(positions, chunksize)]
+
+    results = _run_segments(_regression_segment, tasks, {
+        "data": df, "models": models, "designs": segment_designs},
+        workers or 1)
+    return pd.concat(results) if results else pd.Series(dtype='float64')
+
+
+# the fingerprint of every input row, the signatures of the designs and the
+# predictions of the last incremental hedonic run, keyed by the model
+# config, the table and the output column
+_HEDONIC_PREDICTIONS = {}
+
+
+def _incremental_hedonic_predict(cfg, key, df, chunksize=None, workers=None):
+    """
+    Predict only the rows of df whose values in the model's columns changed
+    since the last run with this key, and keep the last predictions for the
+    rest.  Everything is predicted when the model's config has changed, or
+    when the design of a segment has (e.g. a categorical term has a new
+    level, or the model uses a stateful transform), since that can change
+    the predictions of every row.
+    """
+    entry = _cached_model(cfg)
+    hm = entry["model"]
+    columns = [c for c in entry["columns_used"] if c in df.columns]
+    fingerprints = pd.util.hash_pandas_object(df[columns], index=False)
+
+    last = _HEDONIC_PREDICTIONS.get(key)
+    same = None
+    if last is not None and last["stamp"] == entry["stamp"] and \
+            last["signatures"] is not None:
+        same = fingerprints.reindex(last["fingerprints"].index) == \
+            last["fingerprints"]
+        same = same.reindex(df.index).fillna(False).values.astype('bool')
+
+    designs = {}
+    predictions = _hedonic_predict(
+        hm, df, chunksize, workers, rows=None if same is None else ~same,
+        signatures=None if same is None else last["signatures"],
+        designs=designs)
+    signatures = _design_signatures(designs)
+
+    if same is not None and signatures == last["signatures"]:
+        print("Re-predicted {:,} of {:,} rows".format(
+            int((~same).sum()), len(df)))
+        kept = last["predictions"]
+        kept = kept[kept.index.isin(df.index[same])]
+        predictions = pd.concat([kept, predictions])
+        predictions = predictions.reindex(
+            df.index[df.index.isin(predictions.index)])
+
+    _HEDONIC_PREDICTIONS[key] = {
+        "stamp": entry["stamp"],
+        "fingerprints": fingerprints,
+        "signatures": signatures,
+        "predictions": predictions
+    }
+    return predictions
+
+
+def _lcm_segment(task):
+    name, seed = task
+    inputs = _SEGMENT_INPUTS
+    model = inputs["models"][name]
+    choosers, alternatives = model.apply_predict_filters(
+        inputs["choosers"].iloc[inputs["positions"][name]],
+        inputs["alternatives"])
+    if len(choosers) == 0 or len(alternatives) == 0:
+        return choosers.index, None
+    if seed is None:
+        return choosers.index, model.probabilities(
+            choosers, alternatives, filter_tables=False)
+
+    # urbansim samples from numpy's global state, and when the segments run
+    # in this process the caller's draws (the choices) have to carry on
+    # from where they were, just as they do in a forked worker
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        return choosers.index, model.probabilities(
+            choosers, alternatives, filter_tables=False)
+    finally:
+        np.random.set_state(state)
+
+
+def _segment_probabilities(lcm, choosers, alternatives, workers):
+    """
+    Compute the probabilities of each segment of a segmented location
+    choice model on a pool of worker processes.
+
+    Returns
+    -------
+    A list of (segment name, chooser ids, probabilities) in the order the
+    segments are predicted in, where the chooser ids are the choosers which
+    pass the segment's filters and the probabilities are None when no
+    alternatives pass them.
+    """
+    choosers, alternatives = lcm._filter_choosers_alts(choosers, alternatives)
+    models = lcm._group.models
+    positions = choosers.groupby(lcm.segmentation_col).indices
+    names = [name for name in sorted(positions) if name in models]
+
+    # sampling alternatives is the only random part of the probabilities,
+    # and each segment gets its own seed (drawn here, in segment order) so
+    # that the result doesn't depend on which worker runs which segment
+    seeds = [None] * len(names)
+    if any(models[name].prediction_sample_size is not None
+           for name in names):
+        seeds = list(np.random.randint(2 ** 31 - 1, size=len(names)))
+
+    results = _run_segments(_lcm_segment, list(zip(names, seeds)), {
+        "choosers": choosers, "alternatives": alternatives,
+        "positions": positions, "models": models}, workers)
+    return [(name, ids, probs)
+            for name, (ids, probs) in zip(names, results)]
+
+
+def _parallel_lcm_predict(lcm, choosers, alternatives, workers):
+    """
+    The equivalent of SegmentedMNLDiscreteChoiceModel.predict with the
+    probabilities of the segments computed on a pool of worker processes.
+    The choices are then made here, one segment after the other, so that
+    remove_alts can take out the alternatives chosen by earlier segments -
+    the remaining probabilities are normalized again when choosing, which
+    is the same as recomputing them without those alternatives.
+    """
+    results = []
+    chosen = []
+    for name, chooser_ids, probs in _segment_probabilities(
+            lcm, choosers, alternatives, workers):
+        if probs is None:
+            if len(chooser_ids) > 0:
+                results.append(pd.Series(index=chooser_ids))
+            continue
+
+        alternative_ids = probs.index.get_level_values('alternative_id')
+        if lcm.remove_alts and len(chosen) > 0:
+            probs = probs[~alternative_ids.isin(np.concatenate(chosen))]
+            alternative_ids = probs.index.get_level_values('alternative_id')
+        if len(probs) == 0:
+            results.append(pd.Series(index=chooser_ids))
+            continue
+
+        model = lcm._group.models[name]
+        if model.choice_mode == 'aggregate':
+            choices = unit_choice(
+                chooser_ids.values, alternative_ids.values, probs.values)
+        else:
+            def mkchoice(p):
+                p = p.reset_index(0, drop=True)
+                return np.random.choice(p.index.values, p=p.values / p.sum())
+            choices = probs.groupby(level='chooser_id', sort=False).\
+                apply(mkchoice)
+
+        chosen.append(choices.dropna().values)
+        results.append(choices)
+
+    return pd.concat(results) if results else pd.Series()
 
 
+# the final price shifters of each submarket from the last supply and demand
+# run, keyed by the model config, the submarket column and the price column -
+# used as the starting point the next year when warm_start is set
+_PRICE_SHIFTERS = {}
+
+
+def _warm_start_multiplier(lcm, choosers, alternatives, submarket_col, key,
+                           submarket_table=None):
+    """
+    Get last year's price shifters for the submarkets of the alternatives
+    which pass the model's filters, to start supply and demand from - from
+    the price_shifters column of the submarket table if there is one, and
+    otherwise from the last run in this process.  Submarkets which weren't
+    shifted last year start at 1.
+    """
+    last = None
+    if submarket_table is not None:
+        tbl = orca.get_table(submarket_table)
+        if "price_shifters" in tbl.columns:
+            last = tbl["price_shifters"]
+    if last is None:
+        last = _PRICE_SHIFTERS.get(key)
+    if last is None:
+        return None
+
+    # supply_and_demand multiplies the base by this year's shifters, so it
+    # has to cover exactly the submarkets of the filtered alternatives
+    _, alternatives = lcm.apply_predict_filters(choosers, alternatives)
+    submarkets = alternatives[submarket_col].unique()
+    return last.reindex(submarkets).fillna(1)
+
+
+class _CountingModel(object):
+    """
+    Stands in for a location choice model in supply_and_demand and counts
+    the calls to summed_probabilities, which is called once per iteration.
+    """
+    def __init__(self, lcm):
+        self._lcm = lcm
+        self.calls = 0
+
+    def summed_probabilities(self, *args, **kwargs):
+        self.calls += 1
+        return self._lcm.summed_probabilities(*args, **kwargs)
+
+    def __getattr__(self, key):
+        return getattr(self._lcm, key)
+
+
+@profiled
+@seeded
 def lcm_simulate(cfg, choosers, buildings, join_tbls, out_fname,
                  supply_fname, vacant_fname,
                  enable_supply_correction=None, cast=False,
                  alternative_ratio=2.0,
-                 move_in_year=None):
+                 move_in_year=None,
+                 capacity_weighted=False,
+                 workers=None):
     """
     Simulate the location choices for the specified choosers
 
@@ -360,7 +2213,10 @@ def lcm_simulate(cfg, choosers, buildings, join_tbls, out_fname,
     enable_supply_correction : Python dict
         Should contain keys "price_col" and "submarket_col" which are set to
         the column names in buildings which contain the column for prices and
-        an identifier which segments buildings into submarkets
+        an identifier which segments buildings into submarkets.  If
+        "warm_start" is True the price shifters start from each submarket's
+        final shifter of the last run (kept in the price_shifters column of
+        the "submarket_table" if given) rather than from 1.
     cast : boolean
         Should the output be cast to match the existing column.
     alternative_ratio : float, optional
@@ -369,10 +2225,44 @@ def lcm_simulate(cfg, choosers, buildings, join_tbls, out_fname,
         alternatives will be sampled to improve computational performance
     move_in_year : int, optional
         Sets column, move_in_year, for choosers who chose a new location
+    capacity_weighted : boolean, optional
+        If True, the buildings themselves are the alternatives, weighted by
+        and limited to their number of vacant units, rather than expanding
+        every building to one row per vacant unit.  This gives the same
+        placements statistically with a fraction of the memory, but only
+        for models with choice_mode 'aggregate' (and probability_mode
+        'single_chooser') - other models are predicted from the units as
+        usual.  It cannot be combined with enable_supply_correction (which
+        needs the unit-level alternatives) and ignores alternative_ratio.
+    workers : int, optional
+        If given and the model is segmented, the probabilities of the
+        segments are computed on this many worker processes at once, which
+        share the choosers and alternatives with this process rather than
+        getting a copy of them.  The choices are still made here in segment
+        order, so the result is the same as predicting them one after the
+        other (apart from which alternatives are sampled, when the model
+        samples them).
+
+    Returns
+    -------
+    A dict describing the run - the number of "choosers", "movers",
+    "alternatives", "alternatives_sampled" and choosers "placed", the
+    "supply_demand_iterations", the "units_memory" of the alternatives in
+    bytes, and the wall and CPU time of each of the "phases".  This is also
+    added to the run report when profiling is enabled.
     """
+    phases = _Phases()
     cfg = misc.config(cfg)
 
+    assert not (capacity_weighted and enable_supply_correction is not None), \
+        "capacity_weighted cannot be used with enable_supply_correction"
+    if capacity_weighted and not _aggregate_choices(load_model(cfg)):
+        print("capacity_weighted needs a model which chooses in aggregate - "
+              "predicting from the units instead")
+        capacity_weighted = False
+
     choosers_df = to_frame(choosers, [], cfg, additional_columns=[out_fname, 'move_in_year'])
+    phases.lap("choosers_to_frame")
 
     additional_columns = [supply_fname, vacant_fname]
     if enable_supply_correction is not None and \
@@ -383,6 +2273,7 @@ def lcm_simulate(cfg, choosers, buildings, join_tbls, out_fname,
         additional_columns += [enable_supply_correction["price_col"]]
     locations_df = to_frame(buildings, join_tbls, cfg,
                             additional_columns=additional_columns)
+    phases.lap("alternatives_to_frame")
 
     available_units = buildings[supply_fname]
     vacant_units = buildings[vacant_fname]
@@ -397,13 +2288,20 @@ def lcm_simulate(cfg, choosers, buildings, join_tbls, out_fname,
 
     # sometimes there are vacant units for buildings that are not in the
     # locations_df, which happens for reasons explained in the warning below
-    indexes = np.repeat(vacant_units.index.values,
-                        vacant_units.values.astype('int'))
-    isin = pd.Series(indexes).isin(locations_df.index)
-    missing = len(isin[isin == False])
-    indexes = indexes[isin.values]
-    units = locations_df.loc[indexes].reset_index()
-    check_nas(units)
+    if capacity_weighted:
+        isin = vacant_units.index.isin(locations_df.index)
+        missing = int(vacant_units[~isin].sum())
+        alternatives = locations_df.loc[vacant_units.index[isin]]
+        capacity = vacant_units[isin].astype('int')
+    else:
+        indexes = np.repeat(vacant_units.index.values,
+                            vacant_units.values.astype('int'))
+        isin = pd.Series(indexes).isin(locations_df.index)
+        missing = len(isin[isin == False])
+        indexes = indexes[isin.values]
+        units = locations_df.loc[indexes].reset_index()
+        check_nas(units)
+    alternatives_df = alternatives if capacity_weighted else units
 
     print("    for a total of {:,} temporarily empty units".format(vacant_units.sum()))
     print("    in {:,} buildings total in the region".format(len(vacant_units)))
@@ -416,6 +2314,9 @@ def lcm_simulate(cfg, choosers, buildings, join_tbls, out_fname,
 
     movers = choosers_df[choosers_df[out_fname] == -1]
     print("There are {:,} total movers for this LCM".format(len(movers)))
+    phases.lap("unit_expansion")
+
+    supply_demand_iterations = 0
 
     if enable_supply_correction is not None:
         assert isinstance(enable_supply_correction, dict)
@@ -424,30 +2325,35 @@ def lcm_simulate(cfg, choosers, buildings, join_tbls, out_fname,
         assert "submarket_col" in enable_supply_correction
         submarket_col = enable_supply_correction["submarket_col"]
 
-        lcm = yaml_to_class(cfg).from_yaml(str_or_buffer=cfg)
+        lcm = load_model(cfg)
 
+        submarket_table = enable_supply_correction.get("submarket_table", None)
+        base_multiplier = None
         if enable_supply_correction.get("warm_start", False) is True:
-            raise NotImplementedError()
+            base_multiplier = _warm_start_multiplier(
+                lcm, movers, units, submarket_col,
+                (cfg, submarket_col, price_col), submarket_table)
 
         multiplier_func = enable_supply_correction.get("multiplier_func", None)
         if multiplier_func is not None:
             multiplier_func = orca.get_injectable(multiplier_func)
 
         kwargs = enable_supply_correction.get('kwargs', {})
+        lcm = _CountingModel(lcm)
         new_prices, submarkets_ratios = supply_and_demand(
             lcm,
             movers,
             units,
             submarket_col,
             price_col,
-            base_multiplier=None,
+            base_multiplier=base_multiplier,
             multiplier_func=multiplier_func,
             **kwargs)
+        _PRICE_SHIFTERS[(cfg, submarket_col, price_col)] = submarkets_ratios
 
         # we will only get back new prices for those alternatives
         # that pass the filter - might need to specify the table in
         # order to get the complete index of possible submarkets
-        submarket_table = enable_supply_correction.get("submarket_table", None)
         if submarket_table is not None:
             submarkets_ratios = submarkets_ratios.reindex(
                 orca.get_table(submarket_table).index).fillna(1)
@@ -463,39 +2369,58 @@ def lcm_simulate(cfg, choosers, buildings, join_tbls, out_fname,
         # shifters directly to buildings and ignore unit prices
         orca.add_column(buildings.name,
                         price_col+"_hedonic", buildings[price_col])
+        _table_changed(buildings.name, [price_col+"_hedonic"])
         new_prices = buildings[price_col] * \
             submarkets_ratios.loc[buildings[submarket_col]].values
-        buildings.update_col_from_series(price_col, new_prices)
+        update_col_from_series(buildings, price_col, new_prices)
         print("Adjusted Prices")
         print(buildings[price_col].describe())
+        supply_demand_iterations = lcm.calls
+        phases.lap("supply_and_demand")
 
     if len(movers) > vacant_units.sum():
         print("WARNING: Not enough locations for movers")
         print("    reducing locations to size of movers for performance gain")
         movers = movers.head(int(vacant_units.sum()))
 
+    if not capacity_weighted and \
+            len(units) > len(movers) * alternative_ratio:
+        alternatives_sampled = int(np.floor(len(movers) * alternative_ratio))
+    else:
+        alternatives_sampled = len(alternatives_df)
+
     # returns mapping of chooser ID to alternative ID. Some choosers
     # will map to a nan value when there are not enough alternatives
     # for all the choosers.
-    new_units, _ = yaml_to_class(cfg).predict_from_cfg(movers, units, cfg, 
-                                        alternative_ratio=alternative_ratio)
+    lcm = load_model(cfg)
+    if capacity_weighted:
+        new_buildings = _capacity_weighted_predict(lcm, movers, alternatives,
+                                                   capacity, workers)
+
+        # nans stay as -1s, and the choices are already building ids
+        new_buildings = new_buildings.dropna().\
+            astype(locations_df.index.dtype)
+    else:
+        new_units = _lcm_predict(lcm, movers, units, alternative_ratio,
+                                 workers)
 
-    # new_units returns nans when there aren't enough units,
-    # get rid of them and they'll stay as -1s
-    new_units = new_units.dropna()
+        # new_units returns nans when there aren't enough units,
+        # get rid of them and they'll stay as -1s
+        new_units = new_units.dropna()
 
-    # for households: go from units dataframe index to unit_id
-    new_buildings = pd.Series(units.loc[new_units.values][out_fname].values,
-                              index=new_units.index)
+        # for households: go from units dataframe index to unit_id
+        new_buildings = pd.Series(units.loc[new_units.values][out_fname].values,
+                                  index=new_units.index)
+    phases.lap("predict")
 
-    choosers.update_col_from_series(out_fname, new_buildings, cast=cast)
+    _relocate_agents(choosers, out_fname, new_buildings, cast=cast)
     _print_number_unplaced(choosers, out_fname)
 
     if move_in_year: 
-        move_in_year_series = pd.Series(data=move_in_year, index=new_units.index)
-        choosers.update_col_from_series("move_in_year", move_in_year_series, cast=True)
+        move_in_year_series = pd.Series(data=move_in_year, index=new_buildings.index)
+        update_col_from_series(choosers, "move_in_year", move_in_year_series, cast=True)
         print("choosers[{},move_in_year] = \n{}".format(out_fname, 
-            choosers.to_frame(columns=[out_fname,'move_in_year']).loc[new_units.index]))
+            choosers.to_frame(columns=[out_fname,'move_in_year']).loc[new_buildings.index]))
 
     if enable_supply_correction is not None:
         new_prices = buildings[price_col]
@@ -505,13 +2430,30 @@ def lcm_simulate(cfg, choosers, buildings, join_tbls, out_fname,
         if "clip_final_price_high" in enable_supply_correction:
             new_prices = new_prices.clip(upper=enable_supply_correction[
                 "clip_final_price_high"])
-        buildings.update_col_from_series(price_col, new_prices)
+        update_col_from_series(buildings, price_col, new_prices)
+
+    phases.lap("write_back")
 
     vacant_units = buildings[vacant_fname]
     print("    and there are now {:,} empty units".format(vacant_units.sum()))
     print("    and {:,} overfull buildings".format(len(vacant_units[vacant_units < 0])))
 
-
+    stats = {
+        "choosers": len(choosers_df),
+        "movers": len(movers),
+        "alternatives": len(alternatives_df),
+        "alternatives_sampled": alternatives_sampled,
+        "placed": len(new_buildings),
+        "supply_demand_iterations": supply_demand_iterations,
+        "units_memory": int(alternatives_df.memory_usage().sum()),
+        "phases": phases.times
+    }
+    _profile_detail(stats)
+    return stats
+
+
+@profiled
+@seeded
 def simple_relocation(choosers, relocation_rate, fieldname, cast=False):
     """
     Run a simple rate based relocation model
@@ -538,12 +2480,14 @@ def simple_relocation(choosers, relocation_rate, fieldname, cast=False):
     print("Assigning for relocation...")
     chooser_ids = np.random.choice(choosers.index, size=int(relocation_rate *
                                    len(choosers)), replace=False)
-    choosers.update_col_from_series(fieldname,
-                                    pd.Series(-1, index=chooser_ids), cast=cast)
+    _relocate_agents(choosers, fieldname,
+                     pd.Series(-1, index=chooser_ids), cast=cast)
 
     _print_number_unplaced(choosers, fieldname)
 
 
+@profiled
+@seeded
 def simple_transition(tbl, rate, location_fname):
     """
     Run a simple growth rate transition model on the table passed in
@@ -570,9 +2514,11 @@ def simple_transition(tbl, rate, location_fname):
     print("%d agents after transition" % len(df.index))
 
     df.loc[added, location_fname] = -1
-    orca.add_table(tbl.name, df)
+    _replace_agents(tbl, df, location_fname, removed)
 
 
+@profiled
+@seeded
 def full_transition(agents, agent_controls, year, settings, location_fname, linked_tables=None):
     """
     Run a transition model based on control totals specified in the usual
@@ -617,10 +2563,11 @@ def full_transition(agents, agent_controls, year, settings, location_fname, link
     new, added_hh_idx, new_linked = model.transition(hh, year, linked_tables=linked_tables)
     new.loc[added_hh_idx, location_fname] = -1
     print("Total agents after transition: {:,}".format(len(new)))
-    orca.add_table(agents.name, new)
+    _replace_agents(agents, new, location_fname,
+                    hh.index.difference(new.index))
     for table_name, table in new_linked.items():
         print("Total {} after transition: {:.}".format(table_name, len(table)))
-        orca.add_table(table_name, table)
+        add_table(table_name, table)
 
 
 def _print_number_unplaced(df, fieldname):
@@ -628,6 +2575,7 @@ def _print_number_unplaced(df, fieldname):
           df[fieldname].value_counts().get(-1, 0)))
 
 
+@profiled
 def run_feasibility(parcels, parcel_price_callback,
                     parcel_use_allowed_callback, residential_to_yearly=True,
                     parcel_filter=None, only_built=True, forms_to_test=None,
@@ -720,7 +2668,7 @@ def run_feasibility(parcels, parcel_price_callback,
 
     far_predictions = pd.concat(d.values(), keys=d.keys(), axis=1)
 
-    orca.add_table("feasibility", far_predictions)
+    add_table("feasibility", far_predictions)
 
 
 def _remove_developed_buildings(old_buildings, new_buildings, unplace_agents):
@@ -730,9 +2678,9 @@ def _remove_developed_buildings(old_buildings, new_buildings, unplace_agents):
 
     if "dropped_buildings" in orca.orca._TABLES:
         prev_drops = orca.get_table("dropped_buildings").to_frame()
-        orca.add_table("dropped_buildings", pd.concat([drop_buildings, prev_drops]))
+        add_table("dropped_buildings", pd.concat([drop_buildings, prev_drops]))
     else:
-        orca.add_table("dropped_buildings", drop_buildings)
+        add_table("dropped_buildings", drop_buildings)
 
     old_buildings = old_buildings[np.logical_not(redev_buildings)]
     l2 = len(old_buildings)
@@ -741,17 +2689,21 @@ def _remove_developed_buildings(old_buildings, new_buildings, unplace_agents):
             format(l-l2))
 
     for tbl in unplace_agents:
-        agents = orca.get_table(tbl).local
+        agents = orca.get_table(tbl)
         displaced_agents = agents.building_id.isin(drop_buildings.index)
-        print("Unplaced {} before: {}".format(tbl, len(agents.query(
+        print("Unplaced {} before: {}".format(tbl, len(agents.local.query(
                                               "building_id == -1"))))
-        agents.building_id[displaced_agents] = -1
-        print("Unplaced {} after: {}".format(tbl, len(agents.query(
+        _relocate_agents(agents, "building_id",
+                         pd.Series(-1, index=agents.index[displaced_agents.values]),
+                         cast=True)
+        print("Unplaced {} after: {}".format(tbl, len(agents.local.query(
                                              "building_id == -1"))))
 
     return old_buildings
 
 
+@profiled
+@seeded
 def run_developer(forms, agents, buildings, supply_fname, parcel_size,
                   ave_unit_size, total_units, feasibility, year=None,
                   target_vacancy=.1, form_to_btype_callback=None,
@@ -829,6 +2781,7 @@ def run_developer(forms, agents, buildings, supply_fname, parcel_size,
     """
     feasibility_df = feasibility.to_frame()
     feasibility_columns = sorted(feasibility_df.columns.tolist())
+    old_frame = buildings.local
 
     dev = developer.Developer(feasibility_df)
 
@@ -854,7 +2807,7 @@ def run_developer(forms, agents, buildings, supply_fname, parcel_size,
                              bldg_sqft_per_job=bldg_sqft_per_job,
                              profit_to_prob_func=profit_to_prob_func)
 
-    orca.add_table("feasibility", dev.feasibility)
+    add_table("feasibility", dev.feasibility)
 
     if new_buildings is None:
         return
@@ -898,11 +2851,13 @@ def run_developer(forms, agents, buildings, supply_fname, parcel_size,
                                          return_index=True)
     ret_buildings.index = new_index
 
-    orca.add_table("buildings", all_buildings)
+    add_table("buildings", all_buildings)
+    _buildings_replaced(old_frame, new_buildings.parcel_id)
 
     return ret_buildings
 
 
+@profiled
 def scheduled_development_events(buildings, new_buildings,
                                  remove_developed_buildings=True,
                                  unplace_agents=['households', 'jobs']):
@@ -924,6 +2879,7 @@ def scheduled_development_events(buildings, new_buildings,
     print("Adding {:,} buildings as scheduled development events".format(
           len(new_buildings)))
 
+    old_frame = buildings.local
     old_buildings = buildings.to_frame(buildings.local_columns)
     new_buildings = new_buildings[buildings.local_columns]
 
@@ -939,10 +2895,904 @@ def scheduled_development_events(buildings, new_buildings,
     print("Res units after: {:,}".format(all_buildings.residential_units.sum()))
     print("Non-res sqft after: {:,}".format(all_buildings.non_residential_sqft.sum()))
 
-    orca.add_table("buildings", all_buildings)
+    add_table("buildings", all_buildings)
+    _buildings_replaced(old_frame, new_buildings.parcel_id)
     return new_buildings
 
 
+# the values aggregated by accessibility_variables in incremental mode,
+# keyed like its groups of variables - holding the network they were
+# computed on, the totals of the values at each node and the raw result of
+# each (radius, aggregation, decay) query
+_ACCESSIBILITY = {}
+
+# if more than this share of the nodes need to be recomputed it's faster to
+# let pandana aggregate the whole network
+_INCREMENTAL_ACCESSIBILITY_SHARE = .5
+
+
+def _node_totals(node_ids, variable):
+    df = pd.DataFrame({
+        "node_id": node_ids.values,
+        "value": variable.values if variable is not None else 1.0
+    })
+    return df.groupby("node_id")["value"].agg(["sum", "count"])
+
+
+def _changed_nodes(old_totals, new_totals):
+    index = old_totals.index.union(new_totals.index)
+    old_totals = old_totals.reindex(index).fillna(0)
+    new_totals = new_totals.reindex(index).fillna(0)
+    changed = (old_totals.values != new_totals.values).any(axis=1)
+    return index[changed].values
+
+
+def _update_aggregation(net, values, totals, changed_nodes,
+                        radius, agg, decay):
+    """
+    Recompute a sum, count or mean aggregation at the nodes which can reach
+    one of the changed nodes, keeping the old values everywhere else.
+    Returns None if the aggregation has to be recomputed in full.
+    """
+    weights = {
+        "flat": lambda d: np.ones(len(d)),
+        "linear": lambda d: 1.0 - d / radius,
+        "exp": lambda d: np.exp(-1.0 * d / radius)
+    }
+    if agg in ("ave", "avg", "average"):
+        agg = "mean"
+    if agg not in ("sum", "count", "mean") or decay not in weights or \
+            not getattr(net, "_twoway", False) or \
+            not hasattr(net, "nodes_in_range"):
+        return None
+    if len(changed_nodes) == 0:
+        return values
+
+    # on a two way network the nodes which can reach a changed node are the
+    # ones within the radius of it
+    changed_nodes = changed_nodes[np.in1d(changed_nodes, values.index.values)]
+    affected = net.nodes_in_range(changed_nodes, radius)["destination"].\
+        unique()
+    if len(affected) > len(values) * _INCREMENTAL_ACCESSIBILITY_SHARE:
+        return None
+
+    # pandana applies the decay to the values but not to the counts, and a
+    # mean is the decayed sum over the count
+    pairs = net.nodes_in_range(affected, radius)
+    d = pairs[net.impedance_names[0]].values
+    node_totals = totals.reindex(pairs["destination"].values).fillna(0)
+    sums = pd.Series(weights[decay](d) * node_totals["sum"].values).\
+        groupby(pairs["source"].values).sum()
+    counts = pd.Series(node_totals["count"].values).\
+        groupby(pairs["source"].values).sum()
+    if agg == "sum":
+        new = sums
+    elif agg == "count":
+        new = counts
+    else:
+        new = (sums / counts.replace(0, 1)).where(counts > 0, 0)
+
+    values = values.copy()
+    values.loc[affected] = new.reindex(affected).fillna(0).values
+    print("    recomputed %d of %d nodes" % (len(affected), len(values)))
+    return values
+
+
+def _accessibility_definitions(cfgnames):
+    import yaml
+    variables = []
+    for cfgname in cfgnames:
+        with open(misc.config(cfgname)) as f:
+            cfg = yaml.safe_load(f)
+        assert "node_col" in cfg, \
+            "Need to specify from where to take the node id"
+        for variable in cfg['variable_definitions']:
+            variables.append((cfg["node_col"], variable))
+    return variables
+
+
+@profiled
+def accessibility_variables(net, cfgnames, incremental=False):
+    """
+    Compute the accessibility variables defined in one or more yaml files
+    (in the format read by urbansim.utils.networks.from_yaml) in a single
+    pass.  Each table is read once with all the columns its variables need,
+    variables which aggregate the same values are set on the network once
+    and then aggregated at each radius and decay, and a query which appears
+    more than once (e.g. in two of the files) is only run once.
+
+    Parameters
+    ----------
+    net : pandana.Network
+        The network, precomputed to the largest radius used
+    cfgnames : list of str
+        The yaml files which define the variables
+    incremental : boolean, optional
+        Reuse the values from the last call for the nodes which can't reach
+        a node whose aggregated values have changed since then (e.g. because
+        buildings, households or jobs were added or removed there), and only
+        recompute the others.  This applies to sum, count and mean
+        aggregations on two way networks, the others are always recomputed
+        in full.
+
+    Returns
+    -------
+    A DataFrame indexed by node id, with one column per variable in the
+    order they are defined
+    """
+    variables = _accessibility_definitions(cfgnames)
+
+    # read each table once, with every column the variables on it need
+    fields = {}
+    for node_col, v in variables:
+        flds = fields.setdefault(v["dataframe"], set([node_col]))
+        if v.get("varname"):
+            flds.add(v["varname"])
+        if "filters" in v:
+            flds.update(util.columns_in_filters(v["filters"]))
+        # extra columns to read, as with networks.from_yaml
+        flds.update(v.get("add_fields", []))
+    frames = {
+        name: orca.get_table(name).to_frame(list(flds))
+        for name, flds in fields.items()
+    }
+
+    # group the variables by the values they aggregate, so the values are
+    # set on the network once per group
+    groups = {}
+    for node_col, v in variables:
+        key = (v["dataframe"], node_col, v.get("varname"),
+               repr(v.get("filters")))
+        groups.setdefault(key, []).append(v)
+
+    nodes = {}
+    for key, group in groups.items():
+        dfname, node_col, vname, _ = key
+        df = frames[dfname]
+        if "filters" in group[0]:
+            df = util.apply_filter_query(df, group[0]["filters"])
+
+        previous = _ACCESSIBILITY.get(key) if incremental else None
+        if previous is not None and previous["net"] is not net:
+            previous = None
+        totals = _node_totals(df[node_col], df[vname] if vname else None)
+        changed_nodes = None
+        if previous is not None:
+            changed_nodes = _changed_nodes(previous["totals"], totals)
+
+        aggregated = {}
+        is_set = False
+        for v in sorted(group, key=lambda v: (v["radius"],
+                                              v.get("decay", "linear"))):
+            print("Computing %s" % v["name"])
+            query = (v["radius"], v.get("aggregation", "sum"),
+                     v.get("decay", "linear"))
+            if query not in aggregated and previous is not None and \
+                    query in previous["values"]:
+                aggregated[query] = _update_aggregation(
+                    net, previous["values"][query], totals, changed_nodes,
+                    *query)
+            if aggregated.get(query) is None:
+                if not is_set:
+                    net.set(df[node_col],
+                            variable=df[vname] if vname else None)
+                    is_set = True
+                aggregated[query] = net.aggregate(
+                    query[0], type=query[1], decay=query[2])
+            s = aggregated[query]
+            if "apply" in v:
+                s = s.apply(eval(v["apply"]))
+            nodes[v["name"]] = s
+
+        if incremental:
+            _ACCESSIBILITY[key] = {
+                "net": net, "totals": totals, "values": aggregated}
+
+    names = []
+    for _, v in variables:
+        if v["name"] not in names:
+            names.append(v["name"])
+    return pd.DataFrame(nodes, index=net.node_ids)[names]
+
+
+class _LockedStore(object):
+    """
+    Serialize reads from an HDFStore, which can't be read from several
+    threads at once, while the rest of the table loading runs in parallel.
+    """
+
+    def __init__(self, store):
+        import threading
+        self._store = store
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._store[key]
+
+    def read_index(self, key):
+        # the storer read_index goes through isn't locked on its own
+        with self._lock:
+            return read_index(self._store, key)
+
+    def __getattr__(self, key):
+        attr = getattr(self._store, key)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+        return locked
+
+
+def _table_arguments(table_name):
+    """
+    The names a function table is called with, read from the source of the
+    function since orca doesn't expose the function itself.  Tables whose
+    source can't be parsed are treated as depending on nothing.
+    """
+    import ast
+    import textwrap
+
+    try:
+        _, _, source = orca.get_raw_table(table_name).func_source_data()
+        func = ast.parse(textwrap.dedent(source)).body[0]
+    except (SyntaxError, TypeError, IOError, IndexError):
+        return []
+    if not isinstance(func, ast.FunctionDef):
+        return []
+    return [arg.arg for arg in func.args.args]
+
+
+def _preload_worker(table_name):
+    # runs in a forked worker, which already has the tables registered
+    t1 = time.time()
+    df = orca.get_table(table_name).local
+    return df, time.time() - t1
+
+
+def _register_preloaded(table_name, df):
+    """
+    Give a function table a frame loaded in another process, while keeping
+    it a function table - the first call returns the frame and any call
+    after the cache is cleared runs the table's own function again.
+    """
+    raw = orca.get_raw_table(table_name)
+    loaded = [df]
+
+    def preloaded():
+        if loaded:
+            return loaded.pop()
+        return raw.to_frame(raw.local_columns)
+
+    orca.add_table(table_name, preloaded, cache=True,
+                   cache_scope=raw.cache_scope, copy_col=raw.copy_col)
+    _table_changed(table_name)
+
+
+@profiled
+def preload_tables(table_names, workers=4, executor="thread"):
+    """
+    Load the given (cached) tables concurrently before the simulation
+    starts, instead of one after another as they're first used.  Tables
+    which depend on other tables in the list are loaded after them.
+
+    Parameters
+    ----------
+    table_names : list of str
+        The tables to load
+    workers : int, optional
+        The number of threads or processes to load the tables with
+    executor : str, optional
+        "thread" loads the tables in a thread pool, and "process" in a pool
+        of forked processes (so it needs a platform with fork), which share
+        this process's registered tables rather than importing them again.
+        With processes only the tables which don't depend on others in the
+        list are loaded in the pool, and the rest are loaded here once they
+        have been.  The tables stay function tables either way, so
+        orca.clear_cache still reloads them.
+
+    Returns
+    -------
+    A dictionary of table names to the number of seconds it took to load
+    each table
+    """
+    from concurrent import futures
+
+    assert executor in ("thread", "process"), "Executor not found!"
+    if executor == "process":
+        assert "fork" in multiprocessing.get_all_start_methods(), \
+            "The process executor needs fork"
+
+    table_names = [t for t in table_names
+                   if orca.table_type(t) == "function"]
+
+    # order the tables in waves so that no table is loaded at the same time
+    # as a table it depends on
+    waves = []
+    remaining = list(table_names)
+    while remaining:
+        loading = [t for t in remaining if not any(
+            arg in remaining for arg in _table_arguments(t))]
+        assert loading, "Tables depend on each other: {}".format(remaining)
+        waves.append(loading)
+        remaining = [t for t in remaining if t not in loading]
+
+    # resolve the settings, the store and anything else the tables are
+    # passed (e.g. store_building_ids) in this thread first, so they are
+    # not created several times over or read concurrently by the workers
+    injectables = ["settings", "store"]
+    for table_name in table_names:
+        injectables += [arg for arg in _table_arguments(table_name)
+                        if arg not in injectables]
+    for name in injectables:
+        if orca.is_injectable(name):
+            orca.get_injectable(name)
+    raw_store = None
+    if executor == "thread" and orca.is_injectable("store") and \
+            isinstance(orca.get_injectable("store"), pd.HDFStore):
+        raw_store = orca.get_raw_injectable("store")
+        orca.add_injectable(
+            "store", _LockedStore(orca.get_injectable("store")))
+
+    def load(table_name):
+        t = time.time()
+        orca.get_table(table_name)
+        return table_name, time.time() - t
+
+    timings = {}
+    t1 = time.time()
+    try:
+        if executor == "process" and waves:
+            pool = multiprocessing.get_context("fork").Pool(
+                min(workers, len(waves[0])))
+            try:
+                # map returns the tables in the order of the wave
+                results = pool.map(_preload_worker, waves[0], chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+            for table_name, (df, elapsed) in zip(waves[0], results):
+                _register_preloaded(table_name, df)
+                timings[table_name] = elapsed
+            for table_name in sum(waves[1:], []):
+                timings[table_name] = load(table_name)[1]
+        else:
+            pool = futures.ThreadPoolExecutor(max_workers=workers)
+            try:
+                for wave in waves:
+                    timings.update(pool.map(load, wave))
+            finally:
+                pool.shutdown()
+    finally:
+        if raw_store is not None:
+            # put back what was registered, e.g. the function, without
+            # wrapping it again (which would drop its cached store)
+            orca.add_injectable("store", raw_store, autocall=False)
+
+    for table_name in table_names:
+        print("Loaded table {} in {:.2f} s".format(
+              table_name, timings[table_name]))
+    print("Loaded {} tables in {:.2f} s".format(
+          len(timings), time.time() - t1))
+    return timings
+
+
+def read_index(store, key):
+    """
+    Read the index of a table in a store without reading its columns - HDF5
+    frames and series in either format store their index apart from the
+    values, as does ColumnarStore.
+
+    Parameters
+    ----------
+    store : HDFStore or ColumnarStore
+        The store to read from
+    key : str
+        The name of the table
+
+    Returns
+    -------
+    A numpy array of the index values
+    """
+    if isinstance(store, ColumnarStore):
+        return store.select_index(key).values
+    if isinstance(store, _LockedStore):
+        return store.read_index(key)
+    storer = store.get_storer(key)
+    if storer.is_table:
+        return store.select_column(key, "index").values
+    # the rows of a fixed format frame are its second axis
+    axis = "axis1" if storer.pandas_type == "frame" else "index"
+    return storer.read_index(axis).values
+
+
+# integer positions of a table's foreign keys in the index of the table they
+# point to, keyed by the name of the foreign key column (e.g.
+# "buildings.parcel_id") and rebuilt only when the keys or the index change
+_JOIN_INDEX = {}
+
+
+def _join_positions(index, keys, join_name):
+    entry = _JOIN_INDEX.get(join_name) if join_name is not None else None
+    if entry is not None and \
+            (entry["index"] is index or entry["index"].equals(index)) and \
+            np.array_equal(entry["keys"], keys.values):
+        return entry["positions"]
+
+    positions = index.get_indexer(keys.values)
+    if join_name is not None:
+        _JOIN_INDEX[join_name] = {
+            "index": index,
+            "keys": keys.values.copy(),
+            "positions": positions
+        }
+    return positions
+
+
+def reindex(series1, series2, join_name=None):
+    """
+    The same as urbansim's misc.reindex - reindexes the first series by the
+    second series, e.g. parcels.zone_id by buildings.parcel_id to get the
+    zone_id of each building - but done with a single take of integer
+    positions.  When join_name is given the positions are kept and only
+    recomputed when the foreign keys in series2 or the index of series1
+    change, which is usually not the case from one step to the next.
+
+    Parameters
+    ----------
+    series1 : Series
+        The values to look up, indexed by id
+    series2 : Series
+        The foreign keys, ids into the index of series1
+    join_name : str, optional
+        A name for the relationship to cache the positions under - use the
+        table and column name of the foreign key, e.g. "buildings.parcel_id"
+
+    Returns
+    -------
+    A Series with the index of series2 and the values of series1 (nan where
+    the foreign key isn't found)
+    """
+    positions = _join_positions(series1.index, series2, join_name)
+    values = series1.values
+    missing = positions < 0
+
+    if missing.any():
+        if values.dtype.kind in "iub":
+            values = values.astype("float64")
+        if len(values) == 0:
+            values = np.array([np.nan])
+        result = values.take(np.where(missing, 0, positions))
+        result[missing] = np.nan
+    else:
+        result = values.take(positions)
+
+    return pd.Series(result, index=series2.index, name=series1.name)
+
+
+def sorted_isin(values, sorted_ids):
+    """
+    A vectorized equivalent of Series.isin for when the ids to test against
+    are already sorted, which uses a binary search instead of building a
+    hash table.
+
+    Parameters
+    ----------
+    values : array_like
+        The values to test
+    sorted_ids : numpy array
+        The (sorted, ascending) ids to test membership in
+
+    Returns
+    -------
+    A boolean numpy array, True where the value is in sorted_ids
+    """
+    values = np.asarray(values)
+    if len(sorted_ids) == 0:
+        return np.zeros(len(values), dtype='bool')
+    pos = np.searchsorted(sorted_ids, values)
+    pos[pos == len(sorted_ids)] = 0
+    return sorted_ids[pos] == values
+
+
+def group_codes(index, keys, segments=None, segment_values=None):
+    """
+    Get the position of each row's group in an index, optionally split into
+    segments, for use with the grouped_* reductions - computing the codes
+    once lets several reductions share them instead of each doing its own
+    groupby.
+
+    Parameters
+    ----------
+    index : Index
+        The groups, e.g. the index of the zones table
+    keys : array_like
+        The group of each row, e.g. the zone_id of each building
+    segments : array_like, optional
+        The segment of each row, e.g. the general_type of each building
+    segment_values : list, optional
+        The segments to keep, required if segments is given - rows in other
+        segments are dropped
+
+    Returns
+    -------
+    A numpy array of codes, -1 for rows which aren't in any group.  With
+    segments the code is group position * len(segment_values) + segment
+    position, so the reductions can be reshaped to (groups, segments).
+    """
+    codes = index.get_indexer(np.asarray(keys))
+    if segments is None:
+        return codes
+    segment_codes = pd.Index(segment_values).get_indexer(np.asarray(segments))
+    return np.where((codes >= 0) & (segment_codes >= 0),
+                    codes * len(segment_values) + segment_codes, -1)
+
+
+def grouped_counts(codes, n):
+    """
+    Count the rows in each group, with nan for empty groups (like assigning
+    the result of groupby().size() to a table with all the groups) - the
+    counts are integers when no group is empty.
+    """
+    counts = np.bincount(codes[codes >= 0], minlength=n)
+    if (counts > 0).all():
+        return counts.astype('int64')
+    counts = counts.astype('float')
+    counts[counts == 0] = np.nan
+    return counts
+
+
+def grouped_sums(codes, n, values):
+    """
+    Sum values for each group, skipping nans, with nan for empty groups -
+    the sums of integer values are integers when no group is empty (like
+    assigning the result of groupby().sum() to a table with all the
+    groups).
+    """
+    values = np.asarray(values)
+    keep = codes >= 0
+    has = np.bincount(codes[keep], minlength=n) > 0
+    if values.dtype.kind in "iub":
+        sums = np.bincount(codes[keep], weights=values[keep], minlength=n)
+        if has.all():
+            return np.round(sums).astype('int64')
+    else:
+        values = values.astype('float')
+        sums = np.bincount(codes[keep],
+                           weights=np.nan_to_num(values[keep]), minlength=n)
+    sums[~has] = np.nan
+    return sums
+
+
+def _value_chunks(codes, values, chunksize):
+    # the rows with a group and a value, a chunk at a time, without copying
+    # (or converting) the whole column at once
+    for start in range(0, len(codes), chunksize):
+        c = codes[start:start + chunksize]
+        v = np.asarray(values[start:start + chunksize], dtype='float')
+        keep = (c >= 0) & ~np.isnan(v)
+        yield c[keep], v[keep]
+
+
+def _approximate_medians(codes, values, n, bins, chunksize):
+    """
+    Stream the values to get each group's range, then histogram each group
+    between its own smallest and largest value, and then histogram again
+    within the bins which hold the middle values.
+    """
+    medians = np.full(n, np.nan)
+    counts = np.zeros(n, dtype='int64')
+    low = np.full(n, np.inf)
+    high = np.full(n, -np.inf)
+    for c, v in _value_chunks(codes, values, chunksize):
+        if len(c) == 0:
+            continue
+        counts += np.bincount(c, minlength=n)
+        order = np.argsort(c, kind='mergesort')
+        c, v = c[order], v[order]
+        starts = np.flatnonzero(np.r_[True, c[1:] != c[:-1]])
+        groups = c[starts]
+        low[groups] = np.minimum(low[groups], np.minimum.reduceat(v, starts))
+        high[groups] = np.maximum(high[groups],
+                                  np.maximum.reduceat(v, starts))
+
+    # the ranks of the middle values, which are averaged like the exact
+    # medians, and how many values are below the interval they are in
+    k_lo, k_hi = (counts - 1) // 2, counts // 2
+    below = np.zeros(n)
+    active = counts > 0
+    low[~active] = high[~active] = 0
+    rows = np.arange(n)
+
+    for last in (False, True):
+        width = (high - low) / bins
+        done = active & (width <= 0)
+        medians[done] = low[done]
+        active &= ~done
+        if not active.any():
+            break
+
+        hist = np.zeros(n * bins)
+        for c, v in _value_chunks(codes, values, chunksize):
+            inside = active[c] & (v >= low[c]) & \
+                ((v < high[c]) | (v == high[c]))
+            c, v = c[inside], v[inside]
+            b = np.clip(((v - low[c]) / width[c]).astype('int'), 0, bins - 1)
+            hist += np.bincount(c * bins + b, minlength=n * bins)
+        hist = hist.reshape(n, bins)
+        cum = below[:, np.newaxis] + hist.cumsum(axis=1)
+        b_lo = np.minimum((cum <= k_lo[:, np.newaxis]).sum(axis=1), bins - 1)
+        b_hi = np.minimum((cum <= k_hi[:, np.newaxis]).sum(axis=1), bins - 1)
+
+        if last:
+            # place the values evenly within their bin
+            def value_at(rank, b):
+                before = cum[rows, b] - hist[rows, b]
+                in_bin = np.maximum(hist[rows, b], 1)
+                return low + width * (b + (rank - before + .5) / in_bin)
+            estimate = (value_at(k_lo, b_lo) + value_at(k_hi, b_hi)) / 2.0
+            medians[active] = estimate[active]
+        else:
+            below = np.where(active, cum[rows, b_lo] - hist[rows, b_lo],
+                             below)
+            low, high = np.where(active, low + width * b_lo, low), \
+                np.where(active, np.minimum(low + width * (b_hi + 1), high),
+                         high)
+
+    return medians
+
+
+def grouped_medians(codes, n, values, approximate=False, bins=256,
+                    chunksize=1000000):
+    """
+    Get the median of values for each group, skipping nans, with nan for
+    groups without values.
+
+    Parameters
+    ----------
+    codes : numpy array
+        The group of each row, from group_codes
+    n : int
+        The number of groups
+    values : array_like
+        The values
+    approximate : boolean, optional
+        The exact medians match groupby().quantile() and sort all the
+        values.  The approximate medians read the values a chunk at a time
+        (three times), so the memory is proportional to the number of
+        groups times bins and not to the number of rows.  Each group is
+        binned between its own smallest and largest value, and the bins
+        holding the middle values are binned again, so the error is at
+        most about the range of the group divided by bins squared (more
+        only when the two middle values fall in different bins).
+    bins : int, optional
+        The number of histogram bins for the approximate medians
+    chunksize : int, optional
+        The number of rows binned at once for the approximate medians
+
+    Returns
+    -------
+    A numpy array of length n
+    """
+    if approximate:
+        return _approximate_medians(codes, values, n, bins, chunksize)
+
+    values = np.asarray(values, dtype='float')
+    keep = (codes >= 0) & ~np.isnan(values)
+    codes, values = codes[keep], values[keep]
+    medians = np.full(n, np.nan)
+    if len(values) == 0:
+        return medians
+
+    order = np.lexsort((values, codes))
+    codes, values = codes[order], values[order]
+    counts = np.bincount(codes, minlength=n)
+    starts = np.cumsum(counts) - counts
+    has = counts > 0
+    lo = starts[has] + (counts[has] - 1) // 2
+    hi = starts[has] + counts[has] // 2
+    medians[has] = (values[lo] + values[hi]) / 2.0
+    return medians
+
+
+def _source_stamp(path):
+    st = os.stat(path)
+    return [st.st_mtime, st.st_size]
+
+
+def write_columnar_store(hdf_path, path, tables=None):
+    """
+    Convert an HDF5 store into a columnar snapshot which can be read with
+    ColumnarStore.  Each column (and the index) of each table is written to
+    its own .npy file so that it can be memory mapped and read on its own.
+
+    Parameters
+    ----------
+    hdf_path : str
+        The path of the HDF5 store to convert
+    path : str
+        The directory to write the snapshot to - it is created if it does
+        not exist
+    tables : list of str, optional
+        The tables to convert - by default all the tables in the store
+
+    Returns
+    -------
+    Nothing
+    """
+    store = pd.HDFStore(hdf_path, mode='r')
+    tables = tables or [k.strip("/") for k in store.keys()]
+    manifest = {"source": _source_stamp(hdf_path), "tables": {}}
+
+    for name in tables:
+        df = store[name]
+        print("Writing {:,} rows and {} columns of table {} to {}".format(
+              len(df), len(df.columns), name, path))
+        table_dir = os.path.join(path, name)
+        if not os.path.exists(table_dir):
+            os.makedirs(table_dir)
+
+        def save(fname, values):
+            # object arrays can't be memory mapped, but are still saved so
+            # the snapshot has everything the store had
+            np.save(os.path.join(table_dir, fname), values,
+                    allow_pickle=values.dtype == object)
+
+        save("index.npy", np.asarray(df.index.values))
+        columns = {}
+        for i, col in enumerate(df.columns):
+            s = df[col]
+            fname = "{}.npy".format(i)
+            if str(s.dtype) == "category":
+                save(fname, np.asarray(s.cat.codes.values))
+                save("{}_categories.npy".format(i),
+                     np.asarray(s.cat.categories.values))
+                columns[col] = {"file": fname, "categorical": True}
+            else:
+                save(fname, np.asarray(s.values))
+                columns[col] = {"file": fname, "categorical": False}
+
+        manifest["tables"][name] = {
+            "index_name": df.index.name,
+            "columns": list(df.columns),
+            "files": columns
+        }
+    store.close()
+
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def columnar_store_is_current(hdf_path, path):
+    """
+    Check whether the columnar snapshot at path exists and was written from
+    the current version of the HDF5 store at hdf_path.
+    """
+    fname = os.path.join(path, "manifest.json")
+    if not os.path.exists(fname):
+        return False
+    with open(fname) as f:
+        manifest = json.load(f)
+    return manifest["source"] == _source_stamp(hdf_path)
+
+
+class ColumnarStore(object):
+    """
+    A read-only store of tables written by write_columnar_store, which can
+    be used in place of a pandas HDFStore to load tables with store[name].
+    Columns are memory mapped copy-on-write (so changes made by the
+    simulation are never written back) and each is kept in its own block
+    of the frame, so a column is only read from disk when it is used.
+    This lasts until pandas consolidates the frame, which some whole-frame
+    operations do - the columns of each dtype are then read into memory
+    together.  Columns of strings (object arrays) can't be mapped and are
+    always read in full.
+
+    Parameters
+    ----------
+    path : str
+        The directory the snapshot was written to
+    columns : dict, optional
+        A dictionary of table names to lists of column names - when a table
+        is in the dictionary only these columns are in the frames returned
+        for it (unless select is called with other columns).  Otherwise
+        every column is mapped, and only read when it's used.  Make sure
+        the list includes any columns used to filter or fill the table when
+        it's loaded.
+    """
+
+    def __init__(self, path, columns=None):
+        self.path = path
+        self.columns = columns or {}
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+
+    def keys(self):
+        return ["/" + name for name in self.manifest["tables"]]
+
+    def __contains__(self, key):
+        return key.strip("/") in self.manifest["tables"]
+
+    def __getitem__(self, key):
+        return self.select(key)
+
+    def __getattr__(self, key):
+        if key != "manifest" and key in self.manifest["tables"]:
+            return self.select(key)
+        raise AttributeError(key)
+
+    def _load(self, name, fname):
+        fname = os.path.join(self.path, name, fname)
+        try:
+            return np.load(fname, mmap_mode='c')
+        except ValueError:
+            # object arrays have to be read into memory
+            return np.load(fname, allow_pickle=True)
+
+    def select_index(self, key):
+        """
+        Read the index of a table, without reading any of its columns.
+        """
+        name = key.strip("/")
+        table = self.manifest["tables"][name]
+        return pd.Index(self._load(name, "index.npy"),
+                        name=table["index_name"])
+
+    def select_column(self, key, column):
+        """
+        Read a single column of a table as a Series, without reading any of
+        the other columns.
+        """
+        name = key.strip("/")
+        table = self.manifest["tables"][name]
+        return pd.Series(self._column(name, table["files"][column]),
+                         name=column)
+
+    def _column(self, name, info):
+        values = self._load(name, info["file"])
+        if info["categorical"]:
+            categories = self._load(
+                name, info["file"].replace(".npy", "_categories.npy"))
+            values = pd.Categorical.from_codes(values, categories)
+        return values
+
+    def select(self, key, columns=None):
+        """
+        Read a table, optionally only some of its columns.
+
+        Parameters
+        ----------
+        key : str
+            The name of the table
+        columns : list of str, optional
+            The columns to read - by default the columns configured for this
+            table when the store was created, or all of them
+
+        Returns
+        -------
+        A DataFrame
+        """
+        name = key.strip("/")
+        table = self.manifest["tables"][name]
+        columns = columns or self.columns.get(name) or table["columns"]
+
+        index = self.select_index(key)
+        if len(columns) == 0:
+            return pd.DataFrame(index=index)
+        # concatenating the columns keeps each one in its own block, where
+        # building the frame from a dict can consolidate them (reading them
+        # all into memory) depending on the version of pandas
+        return pd.concat(
+            [pd.Series(self._column(name, table["files"][col]), index=index,
+                       name=col, copy=False) for col in columns],
+            axis=1, copy=False)
+
+    def close(self):
+        pass
+
+
 class SimulationSummaryData(object):
     """
     Keep track of zone-level and parcel-level output for use in the
@@ -14,13 +14,15 @@ from urbansim_defaults import utils
 
 @orca.column('buildings', 'node_id', cache=True, cache_scope='step')
 def node_id(buildings, parcels):
-    print("buildings node_id(): misc.reindex(parcels.node_id, buildings.parcel_id)")
-    return misc.reindex(parcels.node_id, buildings.parcel_id)
+    print("buildings node_id(): utils.reindex(parcels.node_id, buildings.parcel_id)")
+    return utils.reindex(parcels.node_id, buildings.parcel_id,
+                         "buildings.parcel_id")
 
 
 @orca.column('buildings', 'zone_id', cache=True, cache_scope='step')
 def zone_id(buildings, parcels):
-    return misc.reindex(parcels.zone_id, buildings.parcel_id)
+    return utils.reindex(parcels.zone_id, buildings.parcel_id,
+                         "buildings.parcel_id")
 
 
 @orca.column('buildings', 'general_type', cache=True)
@@ -35,7 +37,8 @@ def unit_sqft(buildings):
 
 @orca.column('buildings', 'lot_size_per_unit', cache=True)
 def lot_size_per_unit(buildings, parcels):
-    return misc.reindex(parcels.lot_size_per_unit, buildings.parcel_id)
+    return utils.reindex(parcels.lot_size_per_unit, buildings.parcel_id,
+                         "buildings.parcel_id")
 
 
 @orca.column('buildings', 'sqft_per_job', cache=True)
@@ -50,15 +53,21 @@ def job_spaces(buildings):
 
 
 @orca.column('buildings', 'vacant_residential_units')
-def vacant_residential_units(buildings, households):
-    return buildings.residential_units.sub(
-        households.building_id.value_counts(), fill_value=0)
+def vacant_residential_units(buildings, households, settings):
+    if settings.get("occupancy_counters", False):
+        counts = utils.occupancy_counts(households, "building_id")
+    else:
+        counts = households.building_id.value_counts()
+    return buildings.residential_units.sub(counts, fill_value=0)
 
 
 @orca.column('buildings', 'vacant_job_spaces')
-def vacant_job_spaces(buildings, jobs):
-    return buildings.job_spaces.sub(
-        jobs.building_id.value_counts(), fill_value=0)
+def vacant_job_spaces(buildings, jobs, settings):
+    if settings.get("occupancy_counters", False):
+        counts = utils.occupancy_counts(jobs, "building_id")
+    else:
+        counts = jobs.building_id.value_counts()
+    return buildings.job_spaces.sub(counts, fill_value=0)
 
 
 #####################
@@ -77,13 +86,15 @@ def income_quartile(households):
 
 @orca.column('households', 'zone_id', cache=True, cache_scope='step')
 def zone_id(households, buildings):
-    return misc.reindex(buildings.zone_id, households.building_id)
+    return utils.reindex(buildings.zone_id, households.building_id,
+                         "households.building_id")
 
 
 @orca.column('households', 'node_id', cache=True, cache_scope='step')
 def node_id(households, buildings):
-    print("households node_id(): misc.reindex(buildings.node_id, households.building_id)")
-    return misc.reindex(buildings.node_id, households.building_id)
+    print("households node_id(): utils.reindex(buildings.node_id, households.building_id)")
+    return utils.reindex(buildings.node_id, households.building_id,
+                         "households.building_id")
 
 
 #####################
@@ -93,12 +104,14 @@ def node_id(households, buildings):
 
 @orca.column('jobs', 'node_id', cache=True, cache_scope='step')
 def node_id(jobs, buildings):
-    return misc.reindex(buildings.node_id, jobs.building_id)
+    return utils.reindex(buildings.node_id, jobs.building_id,
+                         "jobs.building_id")
 
 
 @orca.column('jobs', 'zone_id', cache=True, cache_scope='step')
 def zone_id(jobs, buildings):
-    return misc.reindex(buildings.zone_id, jobs.building_id)
+    return utils.reindex(buildings.zone_id, jobs.building_id,
+                         "jobs.building_id")
 
 
 #####################
@@ -118,20 +131,17 @@ def parcel_acres(parcels):
 
 @orca.column('parcels', 'total_residential_units', cache=False)
 def total_residential_units(parcels, buildings):
-    return buildings.residential_units.groupby(buildings.parcel_id).sum().\
-        reindex(parcels.index).fillna(0)
+    return utils.parcel_aggregate(parcels, buildings, "residential_units")
 
 
 @orca.column('parcels', 'total_job_spaces', cache=False)
 def total_job_spaces(parcels, buildings):
-    return buildings.job_spaces.groupby(buildings.parcel_id).sum().\
-        reindex(parcels.index).fillna(0)
+    return utils.parcel_aggregate(parcels, buildings, "job_spaces")
 
 
 @orca.column('parcels', 'total_sqft', cache=False)
 def total_sqft(parcels, buildings):
-    return buildings.building_sqft.groupby(buildings.parcel_id).sum().\
-        reindex(parcels.index).fillna(0)
+    return utils.parcel_aggregate(parcels, buildings, "building_sqft")
 
 
 @orca.column('parcels', 'zoned_du', cache=True)
@@ -150,7 +160,8 @@ def ave_sqft_per_unit(parcels, nodes, settings):
     if len(nodes) == 0:
         # if nodes isn't generated yet
         return pd.Series(index=parcels.index)
-    s = misc.reindex(nodes.ave_sqft_per_unit, parcels.node_id)
+    s = utils.reindex(nodes.ave_sqft_per_unit, parcels.node_id,
+                      "parcels.node_id")
     clip = settings.get("ave_sqft_per_unit_clip", None)
     if clip is not None:
         s = s.clip(lower=clip['lower'], upper=clip['upper'])
@@ -172,5 +183,10 @@ def log_size_per_unit(parcels):
 # for use with historical preservation
 @orca.column('parcels', 'oldest_building')
 def oldest_building(parcels, buildings):
-    return buildings.year_built.groupby(buildings.parcel_id).min().\
-        reindex(parcels.index).fillna(9999)
+    return utils.parcel_aggregate(parcels, buildings, "year_built",
+                                  how="min", fill_value=9999)
+
+
+# record the columns read by each of the columns above so that writes only
+# clear the cached columns which depend on them
+utils.track_column_dependencies()